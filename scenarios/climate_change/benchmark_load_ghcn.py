@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import psycopg2
+import load_control
+from test_load_ghcn_data import DSN
+
+# name -> extra test_load_ghcn_data.py arguments; every mode runs in batch mode
+MODES = {
+    'direct': [],
+    'pipeline': ['--pipeline'],
+    'exchange': ['--exchange'],
+}
+
+LOADER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_load_ghcn_data.py')
+
+def reset_target(conn, truncate=True):
+    """Put every registered file back to PENDING, emptying ghcn_daily_test first unless truncate is False."""
+    if truncate:
+        with conn.cursor() as cur:
+            cur.execute("TRUNCATE ghcn_daily_test")
+        conn.commit()
+    load_control.reset_file_statuses(conn)
+
+def table_stats(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM ghcn_daily_test")
+        rows = cur.fetchone()[0]
+        cur.execute("SELECT status, COUNT(*) FROM ghcn_load_control_test GROUP BY status")
+        statuses = dict(cur.fetchall())
+    return rows, statuses
+
+def run_mode(conn, mode, loader_args, target='empty'):
+    """
+    Load into an empty ghcn_daily_test, or with target='populated' into the
+    rows the previous run left there, as a loader does after its first load.
+    """
+    reset_target(conn, truncate=target == 'empty')
+    rows_before, _ = table_stats(conn)
+    command = [sys.executable, LOADER, '-b'] + loader_args + MODES[mode]
+    print(f"Running {mode} into a {target} target: {' '.join(command[1:])}")
+    started = time.perf_counter()
+    completed = subprocess.run(command, stdout=subprocess.DEVNULL)
+    seconds = time.perf_counter() - started
+    rows, statuses = table_stats(conn)
+    rows -= rows_before
+    return {'mode': mode, 'target': target, 'seconds': seconds, 'rows': rows, 'rows_per_s': rows / seconds if seconds else 0.0,
+            'statuses': statuses, 'exit_code': completed.returncode}
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark GHCN load modes (direct insert vs partition exchange) against the same registered files.')
+    parser.add_argument('-n', type=int, default=1000, help='Number of files each mode loads (default: 1000)')
+    parser.add_argument('-g', type=int, default=4, help='gpfdist processes per host (default: 4)')
+    parser.add_argument('--batch-size', type=int, default=250, help='Files per batch (default: 250)')
+    parser.add_argument('--modes', default=','.join(MODES), help=f'Comma-separated modes to run (default: {",".join(MODES)})')
+    parser.add_argument('--results', default='load_benchmark_results.json', help='JSON file the run is appended to (default: load_benchmark_results.json)')
+    parser.add_argument('--label', default='', help='Free-form label stored with the run, e.g. a git revision')
+    parser.add_argument('--no-populated', action='store_true', help='Only load into an empty target, skipping the second run of each mode into the rows it loaded')
+    parser.add_argument('--yes', action='store_true', help='Confirm that ghcn_daily_test may be truncated and every control row reset; required, as it discards any real load')
+    args = parser.parse_args()
+
+    modes = [m.strip() for m in args.modes.split(',') if m.strip()]
+    unknown = [m for m in modes if m not in MODES]
+    if unknown:
+        parser.error(f"unknown mode(s): {', '.join(unknown)}; choose from {', '.join(MODES)}")
+    if not args.yes:
+        parser.error(f"each mode truncates ghcn_daily_test and resets ghcn_load_control_test on {DSN}; pass --yes to confirm")
+
+    loader_args = ['-n', str(args.n), '-g', str(args.g), '--batch-size', str(args.batch_size)]
+    targets = ['empty'] if args.no_populated else ['empty', 'populated']
+    print("Each mode truncates ghcn_daily_test and resets ghcn_load_control_test first"
+          + ("." if args.no_populated else ", then loads the same files again into the rows it loaded."))
+    conn = psycopg2.connect(DSN)
+    results = []
+    try:
+        for mode in modes:
+            for target in targets:
+                result = run_mode(conn, mode, loader_args, target)
+                results.append(result)
+                print(f"  {mode:<10} {target:<9} {result['seconds']:8.1f}s  {result['rows']:12,} rows  {result['rows_per_s']:12,.0f} rows/s  "
+                      f"files {result['statuses']}" + (f"  (loader exited {result['exit_code']})" if result['exit_code'] else ""))
+    finally:
+        conn.close()
+
+    history = load_history(args.results)
+    history.append({
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'label': args.label,
+        'host': platform.node(),
+        'settings': {'files': args.n, 'gpfdist_per_host': args.g, 'batch_size': args.batch_size, 'targets': targets},
+        'results': results,
+    })
+    with open(args.results, 'w') as f:
+        json.dump(history, f, indent=2)
+    print(f"Results appended to {args.results} ({len(history)} runs recorded)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import os
+import gzip
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import process_ghcn
+
+# name -> ProcessOptions overrides; every case runs through process_dly_file
+CASES = {
+    'legacy': {'engine': 'legacy'},
+    'numpy': {'engine': 'numpy'},
+    'stream': {'engine': 'stream'},
+    'numpy-wide': {'engine': 'numpy', 'output_format': 'wide'},
+    'numpy-gzip': {'engine': 'numpy', 'compress': 'gzip'},
+    'numpy-zstd': {'engine': 'numpy', 'compress': 'zstd'},
+}
+
+# name -> damage done to one line of a valid station; every engine must reject
+# the station rather than write made-up observations
+MALFORMED = {
+    'truncated-line': lambda line: line[:100],
+    'blank-value': lambda line: line[:29] + ' ' * 5 + line[34:],
+    'garbled-value': lambda line: line[:29] + ' 1 2 ' + line[34:],
+}
+
+def corpus_stats(dly_files):
+    lines = 0
+    total_bytes = 0
+    for path in dly_files:
+        with open(path, 'rb') as f:
+            data = f.read()
+        lines += data.count(b"\n")
+        total_bytes += len(data)
+    return {'files': len(dly_files), 'bytes': total_bytes, 'lines': lines}
+
+def read_back(output_dir, chunk_size=1024 * 1024):
+    """
+    Stream every output file back, decompressed, the way gpfdist serves it.
+    Returns (seconds, decompressed bytes).
+    """
+    started = time.perf_counter()
+    total = 0
+    for entry in os.scandir(output_dir):
+        with open(entry.path, 'rb') as raw:
+            if entry.name.endswith('.gz'):
+                f = gzip.GzipFile(fileobj=raw)
+            elif entry.name.endswith('.zst'):
+                import zstandard
+                f = zstandard.ZstdDecompressor().stream_reader(raw)
+            else:
+                f = raw
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                total += len(chunk)
+    return time.perf_counter() - started, total
+
+def malformed_parity(dly_path, cases):
+    """
+    Damage one line of a corpus station in each MALFORMED way and run every
+    case over it. Returns {malformed name: {case: converted ok?}}.
+    """
+    with open(dly_path) as f:
+        lines = f.read().splitlines()
+    work_dir = tempfile.mkdtemp(prefix='ghcn_malformed_')
+    try:
+        outcomes = {}
+        for name, damage in MALFORMED.items():
+            path = os.path.join(work_dir, os.path.basename(dly_path))
+            with open(path, 'w') as f:
+                f.write("\n".join(lines[:1] + [damage(lines[1] if len(lines) > 1 else lines[0])] + lines[2:]) + "\n")
+            outcomes[name] = {case: process_ghcn.process_dly_file(path, work_dir, process_ghcn.ProcessOptions(**CASES[case]))['ok']
+                              for case in cases}
+        return outcomes
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def run_case(dly_files, options):
+    """
+    Convert the corpus with one engine, then read the output back. Runs in a
+    fresh worker process so ru_maxrss reflects this engine alone.
+    """
+    output_dir = tempfile.mkdtemp(prefix='ghcn_bench_')
+    try:
+        started = time.perf_counter()
+        rows = 0
+        failures = 0
+        for path in dly_files:
+            result = process_ghcn.process_dly_file(path, output_dir, options)
+            rows += result['rows']
+            failures += 0 if result['ok'] else 1
+        seconds = time.perf_counter() - started
+        output_bytes = sum(entry.stat().st_size for entry in os.scandir(output_dir))
+        read_seconds, csv_bytes = read_back(output_dir)
+        return {'seconds': seconds, 'rows': rows, 'failures': failures, 'output_bytes': output_bytes,
+                'csv_bytes': csv_bytes, 'read_seconds': read_seconds,
+                'peak_rss_mb': process_ghcn.peak_rss_kb() / 1024}
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark process_ghcn parser engines over a .dly corpus.')
+    parser.add_argument('corpus_dir', help='Directory of .dly files (see generate_synthetic_dly.py)')
+    parser.add_argument('--cases', help=f'Comma-separated cases to run (default: {",".join(CASES)}; numpy-zstd only if zstandard is installed)')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per case; the fastest is reported (default: 1)')
+    parser.add_argument('--results', default='benchmark_results.json', help='JSON file the run is appended to (default: benchmark_results.json)')
+    parser.add_argument('--label', default='', help='Free-form label stored with the run, e.g. a git revision')
+    args = parser.parse_args()
+
+    have_zstd = importlib.util.find_spec('zstandard') is not None
+    if args.cases:
+        cases = [c.strip() for c in args.cases.split(',') if c.strip()]
+    else:
+        cases = [c for c in CASES if have_zstd or CASES[c].get('compress') != 'zstd']
+    unknown = [c for c in cases if c not in CASES]
+    if unknown:
+        parser.error(f"unknown case(s): {', '.join(unknown)}; choose from {', '.join(CASES)}")
+    if not have_zstd and any(CASES[c].get('compress') == 'zstd' for c in cases):
+        parser.error('the zstd case needs the zstandard package (pip install zstandard)')
+
+    dly_files = sorted(os.path.join(args.corpus_dir, f) for f in os.listdir(args.corpus_dir) if f.endswith('.dly'))
+    if not dly_files:
+        parser.error(f"no .dly files found in {args.corpus_dir}")
+
+    corpus = corpus_stats(dly_files)
+    print(f"Corpus: {corpus['files']} files, {corpus['lines']} lines, {corpus['bytes'] / (1024 * 1024):.1f} MB")
+
+    print("Checking that every case rejects malformed stations...")
+    parity = malformed_parity(dly_files[0], cases)
+    for name, outcome in parity.items():
+        accepted = [case for case, ok in outcome.items() if ok]
+        print(f"  {name:<16} " + (f"ACCEPTED by {', '.join(accepted)}" if accepted else "rejected by every case"))
+
+    results = []
+    for case in cases:
+        options = process_ghcn.ProcessOptions(**CASES[case])
+        best = None
+        for _ in range(args.repeat):
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                run = executor.submit(run_case, dly_files, options).result()
+            if best is None or run['seconds'] < best['seconds']:
+                best = run
+        best['case'] = case
+        best['lines_per_s'] = corpus['lines'] / best['seconds'] if best['seconds'] else 0.0
+        best['rows_per_s'] = best['rows'] / best['seconds'] if best['seconds'] else 0.0
+        best['compression_ratio'] = best['csv_bytes'] / best['output_bytes'] if best['output_bytes'] else 0.0
+        results.append(best)
+        print(f"  {case:<12} {best['seconds']:8.2f}s  {best['lines_per_s']:12,.0f} lines/s  {best['rows_per_s']:12,.0f} rows/s  "
+              f"peak RSS {best['peak_rss_mb']:7.1f} MB  output {best['output_bytes'] / (1024 * 1024):8.1f} MB "
+              f"({best['compression_ratio']:.1f}x)  read back {best['read_seconds']:6.2f}s"
+              + (f"  ({best['failures']} failed files)" if best['failures'] else ""))
+
+    history = load_history(args.results)
+    history.append({
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'label': args.label,
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'corpus': dict(corpus, path=os.path.abspath(args.corpus_dir)),
+        'malformed_parity': parity,
+        'results': results,
+    })
+    with open(args.results, 'w') as f:
+        json.dump(history, f, indent=2)
+    print(f"Results appended to {args.results} ({len(history)} runs recorded)")
+
+if __name__ == "__main__":
+    main()
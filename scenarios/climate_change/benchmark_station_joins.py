@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import time
+import platform
+import argparse
+import statistics
+import psycopg2
+from load_station_data import DISTRIBUTIONS
+from test_load_ghcn_data import DSN
+
+# name -> station-observation join; {stations} is the weather_stations copy under test
+QUERIES = {
+    'state': """
+        SELECT d.element, COUNT(*), AVG(d.value)
+        FROM ghcn_daily_test d
+        JOIN {stations} s ON s.station_id = d.station_id
+        WHERE s.state = %(state)s
+        GROUP BY d.element
+    """,
+    'bounding-box': """
+        SELECT EXTRACT(YEAR FROM d.observation_date) AS year, AVG(d.value)
+        FROM ghcn_daily_test d
+        JOIN {stations} s ON s.station_id = d.station_id
+        WHERE s.latitude BETWEEN %(min_lat)s AND %(max_lat)s
+          AND s.longitude BETWEEN %(min_lon)s AND %(max_lon)s
+          AND d.element = 'TMAX'
+        GROUP BY 1
+    """,
+    'elevation': """
+        SELECT s.state, MAX(d.value)
+        FROM ghcn_daily_test d
+        JOIN {stations} s ON s.station_id = d.station_id
+        WHERE s.elevation > %(min_elevation)s
+          AND d.element = 'SNWD'
+        GROUP BY s.state
+    """,
+    'station-names': """
+        SELECT s.station_name, COUNT(*)
+        FROM ghcn_daily_test d
+        JOIN {stations} s ON s.station_id = d.station_id
+        WHERE d.observation_date >= %(since)s
+        GROUP BY s.station_name
+    """,
+}
+
+MOTION = re.compile(r'(Redistribute|Broadcast|Gather|Explicit Redistribute) Motion')
+
+def stations_table(distribution):
+    return f"weather_stations_bench_{distribution}"
+
+def create_station_copies(conn, distributions):
+    """Copy weather_stations once per distribution, so every choice sees the same rows and statistics."""
+    with conn.cursor() as cur:
+        for distribution in distributions:
+            table = stations_table(distribution)
+            cur.execute(f"DROP TABLE IF EXISTS {table}")
+            cur.execute(f"CREATE TABLE {table} AS SELECT * FROM weather_stations {DISTRIBUTIONS[distribution]}")
+            cur.execute(f"ANALYZE {table}")
+    conn.commit()
+
+def drop_station_copies(conn, distributions):
+    with conn.cursor() as cur:
+        for distribution in distributions:
+            cur.execute(f"DROP TABLE IF EXISTS {stations_table(distribution)}")
+    conn.commit()
+
+def plan_motions(cur, sql, params):
+    """Count the motions in the plan by type, e.g. {'Broadcast': 1, 'Gather': 1}."""
+    cur.execute("EXPLAIN " + sql, params)
+    motions = {}
+    for (line,) in cur.fetchall():
+        for match in MOTION.finditer(line):
+            motions[match.group(1)] = motions.get(match.group(1), 0) + 1
+    return motions
+
+def run_query(conn, distribution, query, params, repeat):
+    sql = QUERIES[query].format(stations=stations_table(distribution))
+    with conn.cursor() as cur:
+        motions = plan_motions(cur, sql, params)
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            cur.execute(sql, params)
+            rows = len(cur.fetchall())
+            timings.append(time.perf_counter() - started)
+    conn.rollback()
+    return {'distribution': distribution, 'query': query, 'motions': motions, 'rows': rows,
+            'best_seconds': min(timings), 'median_seconds': statistics.median(timings)}
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark station-observation joins against weather_stations under each distribution policy.')
+    parser.add_argument('--distributions', default=','.join(DISTRIBUTIONS), help=f'Comma-separated distributions to compare (default: {",".join(DISTRIBUTIONS)})')
+    parser.add_argument('--queries', default=','.join(QUERIES), help=f'Comma-separated queries to run (default: {",".join(QUERIES)})')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per query; best and median are reported (default: 3)')
+    parser.add_argument('--state', default='CO', help='State for the state query (default: CO)')
+    parser.add_argument('--bbox', default='37,41,-109,-102', help='min_lat,max_lat,min_lon,max_lon for the bounding-box query (default: 37,41,-109,-102)')
+    parser.add_argument('--min-elevation', type=float, default=2500, help='Elevation threshold in metres for the elevation query (default: 2500)')
+    parser.add_argument('--since', default='2020-01-01', help='Earliest observation_date for the station-names query (default: 2020-01-01)')
+    parser.add_argument('--keep', action='store_true', help='Keep the weather_stations_bench_* copies afterwards')
+    parser.add_argument('--results', default='station_join_results.json', help='JSON file the run is appended to (default: station_join_results.json)')
+    parser.add_argument('--label', default='', help='Free-form label stored with the run, e.g. a git revision')
+    args = parser.parse_args()
+
+    distributions = [d.strip() for d in args.distributions.split(',') if d.strip()]
+    queries = [q.strip() for q in args.queries.split(',') if q.strip()]
+    unknown = [d for d in distributions if d not in DISTRIBUTIONS] + [q for q in queries if q not in QUERIES]
+    if unknown:
+        parser.error(f"unknown distribution(s) or query(ies): {', '.join(unknown)}")
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    try:
+        min_lat, max_lat, min_lon, max_lon = (float(v) for v in args.bbox.split(','))
+    except ValueError:
+        parser.error('--bbox takes four comma-separated numbers: min_lat,max_lat,min_lon,max_lon')
+    params = {'state': args.state, 'min_lat': min_lat, 'max_lat': max_lat, 'min_lon': min_lon, 'max_lon': max_lon,
+              'min_elevation': args.min_elevation, 'since': args.since}
+
+    conn = psycopg2.connect(DSN)
+    results = []
+    try:
+        print(f"Copying weather_stations as {', '.join(stations_table(d) for d in distributions)}")
+        create_station_copies(conn, distributions)
+        for query in queries:
+            for distribution in distributions:
+                result = run_query(conn, distribution, query, params, args.repeat)
+                results.append(result)
+                motions = ', '.join(f"{count} {kind}" for kind, count in sorted(result['motions'].items())) or 'none'
+                print(f"  {query:<14} {distribution:<11} best {result['best_seconds']:8.3f}s  median {result['median_seconds']:8.3f}s  "
+                      f"{result['rows']:8,} rows  motions: {motions}")
+    finally:
+        if not args.keep:
+            conn.rollback()
+            drop_station_copies(conn, distributions)
+        conn.close()
+
+    history = load_history(args.results)
+    history.append({
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'label': args.label,
+        'host': platform.node(),
+        'settings': {'repeat': args.repeat, 'params': params},
+        'results': results,
+    })
+    with open(args.results, 'w') as f:
+        json.dump(history, f, indent=2)
+    print(f"Results appended to {args.results} ({len(history)} runs recorded)")
+
+if __name__ == "__main__":
+    main()
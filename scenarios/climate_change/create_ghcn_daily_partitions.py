@@ -1,16 +1,16 @@
 #!/usr/bin/env python3
 import psycopg2
+import argparse
 
-def drop_table_if_exists(conn):
+def drop_table_if_exists(conn, table_name='ghcn_daily_test'):
     with conn.cursor() as cur:
-        cur.execute("""
-            DROP TABLE IF EXISTS ghcn_daily_test CASCADE;
+        cur.execute(f"""
+            DROP TABLE IF EXISTS {table_name} CASCADE;
         """)
         conn.commit()
-    print("Dropped existing ghcn_daily_test table (if it existed).")
+    print(f"Dropped existing {table_name} table (if it existed).")
 
-def create_table_with_partitions(start_year, end_year, conn):
-    # SQL to create the base table with all partitions
+def yearly_partitions_sql(start_year, end_year):
     partition_definitions = []
     # Loop to create partition definitions for each year
     for year in range(start_year, end_year + 1):
@@ -23,7 +23,11 @@ def create_table_with_partitions(start_year, end_year, conn):
     # Add default partition to handle out-of-range data
     partition_definitions.append("DEFAULT PARTITION p_default")
     # Join all partition definitions into a single string
-    partitions_sql = ",\n".join(partition_definitions)
+    return ",\n".join(partition_definitions)
+
+def create_table_with_partitions(start_year, end_year, conn):
+    # SQL to create the base table with all partitions
+    partitions_sql = yearly_partitions_sql(start_year, end_year)
     # SQL to create the table with all partitions, including the default partition
     create_table_sql = f"""
     CREATE TABLE ghcn_daily_test (
@@ -47,15 +51,53 @@ def create_table_with_partitions(start_year, end_year, conn):
         conn.commit()
     print("Table and partitions (including default) created successfully.")
 
+def create_wide_table_with_partitions(start_year, end_year, conn):
+    # Pivoted layout written by process_ghcn.py --format wide: one row per
+    # station and date, with the core elements as value/qflag column pairs
+    partitions_sql = yearly_partitions_sql(start_year, end_year)
+    create_table_sql = f"""
+    CREATE TABLE ghcn_daily_wide (
+        station_id CHAR(11),
+        observation_date DATE,
+        tmax INTEGER,
+        tmax_qflag VARCHAR(1),
+        tmin INTEGER,
+        tmin_qflag VARCHAR(1),
+        prcp INTEGER,
+        prcp_qflag VARCHAR(1),
+        snow INTEGER,
+        snow_qflag VARCHAR(1),
+        snwd INTEGER,
+        snwd_qflag VARCHAR(1)
+    )
+    WITH (appendonly=true, orientation=column)  -- Column-oriented, append-only table
+    DISTRIBUTED BY (station_id)
+    PARTITION BY RANGE (observation_date) (
+        {partitions_sql}
+    );
+    """
+    with conn.cursor() as cur:
+        cur.execute(create_table_sql)
+        conn.commit()
+    print("Wide table and partitions (including default) created successfully.")
+
 def main():
+    parser = argparse.ArgumentParser(description='Create the partitioned GHCN daily table.')
+    parser.add_argument('--format', choices=['long', 'wide'], default='long', help='long: ghcn_daily_test, one row per observation (default); wide: ghcn_daily_wide, one row per station and date')
+    args = parser.parse_args()
+
     # Connection to the database (adjust as necessary)
     conn = psycopg2.connect("dbname=climate_analysis user=gpadmin host=mdw")
     try:
-        # Drop the existing table if it exists
-        drop_table_if_exists(conn)
+        if args.format == 'wide':
+            drop_table_if_exists(conn, 'ghcn_daily_wide')
+            create_wide_table_with_partitions(1750, 2024, conn)
+        else:
+            # Drop the existing table if it exists
+            drop_table_if_exists(conn)
 
-        # Generate the table and partitions from 1954 to 2024, with a default partition
-        create_table_with_partitions(1750, 2024, conn)
+            # Generate the table and partitions from 1954 to 2024, with a default partition
+            create_table_with_partitions(1750, 2024, conn)
     finally:
         conn.close()
 
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import os
+import math
+import random
+import argparse
+import calendar
+from tqdm import tqdm
+
+DEFAULT_ELEMENTS = 'TMAX,TMIN,PRCP,SNOW,SNWD,TAVG,AWND,WT01,WT03,WT16'
+QUALITY_FLAGS = 'DGIKLMNORSTWXZ'
+SOURCE_FLAGS = '0067ABFHKNSWXZ'
+
+def element_value(element, day_of_year, rng, base_temp):
+    """Plausible value (in GHCN units, mostly tenths) for one element on one day."""
+    season = math.cos(2 * math.pi * (day_of_year - 200) / 365.0)
+    if element in ('TMAX', 'TMIN', 'TAVG'):
+        offset = {'TMAX': 60, 'TMIN': -60, 'TAVG': 0}[element]
+        return int(base_temp + 120 * season + offset + rng.gauss(0, 35))
+    if element == 'PRCP':
+        return 0 if rng.random() < 0.65 else int(rng.expovariate(1 / 60.0))
+    if element in ('SNOW', 'SNWD'):
+        if season > -0.2 or rng.random() < 0.6:
+            return 0
+        return int(rng.expovariate(1 / (40.0 if element == 'SNOW' else 150.0)))
+    if element == 'AWND':
+        return int(abs(rng.gauss(35, 15)))
+    # WT** weather types are presence flags
+    return 1
+
+def station_lines(station_id, start_year, end_year, elements, missing_ratio, rng):
+    base_temp = rng.uniform(-50, 200)
+    for year in range(start_year, end_year + 1):
+        for month in range(1, 13):
+            days_in_month = calendar.monthrange(year, month)[1]
+            day_of_year_start = sum(calendar.monthrange(year, m)[1] for m in range(1, month))
+            for element in elements:
+                parts = [f"{station_id}{year:04d}{month:02d}{element}"]
+                for day in range(1, 32):
+                    if day > days_in_month or rng.random() < missing_ratio:
+                        parts.append("-9999   ")
+                        continue
+                    value = element_value(element, day_of_year_start + day, rng, base_temp)
+                    mflag = 'T' if element == 'PRCP' and value == 0 and rng.random() < 0.05 else ' '
+                    qflag = rng.choice(QUALITY_FLAGS) if rng.random() < 0.005 else ' '
+                    sflag = rng.choice(SOURCE_FLAGS)
+                    parts.append(f"{value:5d}{mflag}{qflag}{sflag}")
+                yield "".join(parts) + "\n"
+
+def generate_station(output_dir, index, args, elements, rng):
+    station_id = f"{rng.choice(['US', 'CA', 'AS', 'GM', 'SW'])}{rng.choice('CW1')}{index:08d}"
+    # Stations have very different record lengths and element sets, which
+    # is what makes real .dly files range from a few KB to tens of MB
+    start_year = rng.randint(args.start_year, args.end_year)
+    station_elements = [e for e in elements if e in ('TMAX', 'TMIN', 'PRCP') or rng.random() < 0.5] or elements[:1]
+    path = os.path.join(output_dir, f"{station_id}.dly")
+    with open(path, 'w') as f:
+        f.writelines(station_lines(station_id, start_year, args.end_year, station_elements, args.missing_ratio, rng))
+    return path
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic GHCN-Daily .dly corpus for benchmarking.')
+    parser.add_argument('--output-dir', default='synthetic_dly', help='Directory to write .dly files to (default: synthetic_dly)')
+    parser.add_argument('--stations', type=int, default=100, help='Number of station files to generate (default: 100)')
+    parser.add_argument('--start-year', type=int, default=1950, help='Earliest year a station record may start (default: 1950)')
+    parser.add_argument('--end-year', type=int, default=2024, help='Last year of every station record (default: 2024)')
+    parser.add_argument('--elements', default=DEFAULT_ELEMENTS, help=f'Comma-separated element mix (default: {DEFAULT_ELEMENTS})')
+    parser.add_argument('--missing-ratio', type=float, default=0.1, help='Fraction of valid days recorded as -9999 (default: 0.1)')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed, so corpora are reproducible (default: 42)')
+    args = parser.parse_args()
+
+    if args.start_year > args.end_year:
+        parser.error('--start-year must not be after --end-year')
+    if not 0 <= args.missing_ratio <= 1:
+        parser.error('--missing-ratio must be between 0 and 1')
+
+    elements = [e.strip().upper() for e in args.elements.split(',') if e.strip()]
+    rng = random.Random(args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    total_bytes = 0
+    for index in tqdm(range(args.stations), desc="Generating stations", unit="station"):
+        total_bytes += os.path.getsize(generate_station(args.output_dir, index, args, elements, rng))
+
+    print(f"Wrote {args.stations} .dly files ({total_bytes / (1024 * 1024):.1f} MB) to {args.output_dir}")
+
+if __name__ == "__main__":
+    main()
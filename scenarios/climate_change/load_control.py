@@ -2,20 +2,59 @@
 
 import psycopg2
 import os
+import io
+import csv
+import gzip
 import argparse
-from tqdm import tqdm  # Import tqdm for progress bar
+
+CSV_SUFFIXES = ('.csv', '.csv.gz', '.csv.zst')
+# Written next to the CSVs by process_ghcn.py: file,rows,bytes,checksum
+OUTPUT_MANIFEST = 'ghcn_output.manifest'
+# The loader's external tables have ghcn_daily_test's 7 columns; wide CSVs
+# (process_ghcn.py --format wide) belong in ghcn_daily_wide instead
+LONG_CSV_HEADER = 'station_id,observation_date,element,value,mflag,qflag,sflag'
+# process_ghcn.py --shards packs many stations into each ghcn_shard_NNNN.csv
+SHARD_PREFIX = 'ghcn_shard_'
+
+def read_csv_header(file_path):
+    """First line of a plain, .csv.gz or .csv.zst file."""
+    if file_path.endswith('.gz'):
+        with gzip.open(file_path, 'rt') as f:
+            return f.readline().strip()
+    if file_path.endswith('.zst'):
+        import zstandard  # optional dependency, only needed for .csv.zst files
+        with open(file_path, 'rb') as raw, zstandard.ZstdDecompressor().stream_reader(raw) as f:
+            return io.TextIOWrapper(f).readline().strip()
+    with open(file_path) as f:
+        return f.readline().strip()
+
+def load_output_manifest(directory):
+    path = os.path.join(directory, OUTPUT_MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline='') as f:
+        return {row['file']: (int(row['rows']), int(row['bytes'])) for row in csv.DictReader(f)}
 
 def get_csv_files(directory):
     """
-    Get a list of all CSV files in the specified directory.
+    Walk the directory once with os.scandir and return (path, size, mtime,
+    row count) for every CSV (plain, .csv.gz or .csv.zst). The row count
+    comes from process_ghcn.py's sidecar manifest when it matches the file's
+    size, and is None otherwise.
     """
+    manifest = load_output_manifest(directory)
     csv_files = []
-    for filename in os.listdir(directory):
-        if filename.endswith('.csv'):
-            csv_files.append(os.path.join(directory, filename))
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.name.endswith(CSV_SUFFIXES) or not entry.is_file():
+                continue
+            st = entry.stat()
+            rows, size = manifest.get(entry.name, (None, None))
+            csv_files.append((os.path.join(directory, entry.name), st.st_size, int(st.st_mtime),
+                              rows if size == st.st_size else None))
     return csv_files
 
-def setup_control_table(conn):
+def setup_control_table(conn, truncate=False):
     with conn.cursor() as cur:
         # Check if the table exists
         cur.execute("""
@@ -27,9 +66,19 @@ def setup_control_table(conn):
         table_exists = cur.fetchone()[0]
 
         if table_exists:
-            # If the table exists, truncate it
-            cur.execute("TRUNCATE TABLE ghcn_load_control_test;")
-            print("Truncated existing ghcn_load_control_test table.")
+            if truncate:
+                cur.execute("TRUNCATE TABLE ghcn_load_control_test;")
+                print("Truncated existing ghcn_load_control_test table.")
+            # Tables created by earlier versions lack the lease and file metadata columns
+            cur.execute("""
+                ALTER TABLE ghcn_load_control_test
+                    ADD COLUMN IF NOT EXISTS owner VARCHAR(255),
+                    ADD COLUMN IF NOT EXISTS lease_expires TIMESTAMP,
+                    ADD COLUMN IF NOT EXISTS heartbeat TIMESTAMP,
+                    ADD COLUMN IF NOT EXISTS file_size BIGINT,
+                    ADD COLUMN IF NOT EXISTS file_mtime BIGINT,
+                    ADD COLUMN IF NOT EXISTS expected_row_count INTEGER;
+            """)
         else:
             # If the table doesn't exist, create it
             cur.execute("""
@@ -39,7 +88,13 @@ def setup_control_table(conn):
                     csv_record_count INTEGER,
                     inserted_row_count INTEGER,
                     error_condition TEXT,
-                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    owner VARCHAR(255),          -- loader (host:pid) holding the lease
+                    lease_expires TIMESTAMP,     -- claim is reclaimable after this
+                    heartbeat TIMESTAMP,         -- last lease renewal by the owner
+                    file_size BIGINT,            -- bytes on disk when registered
+                    file_mtime BIGINT,           -- mtime (epoch seconds) when registered
+                    expected_row_count INTEGER   -- from process_ghcn.py's sidecar manifest, if known
                 );
             """)
             print("Created new ghcn_load_control_test table.")
@@ -47,14 +102,132 @@ def setup_control_table(conn):
         conn.commit()
 
 def insert_csv_files(conn, csv_files):
+    """
+    Register a scan in one COPY FROM STDIN into a temp table, then merge it
+    set-based, in one transaction:
+
+    - new files are inserted as PENDING;
+    - rows registered before file metadata was recorded get their size,
+      mtime and row count filled in, keeping their status;
+    - files whose size or mtime changed go back to PENDING. A changed
+      COMPLETED station CSV has its station's rows deleted from
+      ghcn_daily_test first. A changed COMPLETED shard covers stations that
+      can't be told from its name, so it is marked CHANGED for an explicit
+      reload instead;
+    - PENDING or FAILED CSV rows whose file is gone are removed.
+
+    Files leased to a running loader are left alone. Returns (inserted,
+    changed, busy, removed, backfilled, reloaded, flagged).
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for file_name, size, mtime, rows in csv_files:
+        writer.writerow([file_name, size, mtime, '' if rows is None else rows])
+    buf.seek(0)
+
+    changed_files = """
+        FROM ghcn_control_scan s
+        WHERE c.file_name = s.file_name
+          AND (c.file_size IS DISTINCT FROM s.file_size OR c.file_mtime IS DISTINCT FROM s.file_mtime)
+          AND NOT (c.status = 'IN_PROGRESS' AND c.lease_expires > CURRENT_TIMESTAMP)
+    """
+    # Station CSVs are named <station_id>.csv[.gz|.zst]; shards are ghcn_shard_NNNN.csv[...]
+    shard = f"regexp_replace(c.file_name, '^.*/', '') ~ '^{SHARD_PREFIX}'"
+    csv_file = ' OR '.join(f"c.file_name LIKE '%{suffix}'" for suffix in CSV_SUFFIXES)
+
     with conn.cursor() as cur:
-        # Use tqdm for progress bar
-        for file_name in tqdm(csv_files, desc="Inserting CSV files", unit="file"):
-            cur.execute("""
-                INSERT INTO ghcn_load_control_test (file_name, status)
-                VALUES (%s, 'PENDING');
-            """, (file_name,))
-        conn.commit()
+        cur.execute("""
+            CREATE TEMP TABLE ghcn_control_scan (
+                file_name VARCHAR(255),
+                file_size BIGINT,
+                file_mtime BIGINT,
+                expected_row_count INTEGER
+            ) ON COMMIT DROP DISTRIBUTED BY (file_name)
+        """)
+        cur.copy_expert("COPY ghcn_control_scan FROM STDIN WITH (FORMAT csv)", buf)
+
+        cur.execute("""
+            UPDATE ghcn_load_control_test c
+            SET file_size = s.file_size,
+                file_mtime = s.file_mtime,
+                expected_row_count = COALESCE(c.expected_row_count, s.expected_row_count)
+            FROM ghcn_control_scan s
+            WHERE c.file_name = s.file_name
+              AND c.file_size IS NULL AND c.file_mtime IS NULL
+        """)
+        backfilled = cur.rowcount
+
+        cur.execute("""
+            SELECT COUNT(*)
+            FROM ghcn_control_scan s
+            JOIN ghcn_load_control_test c ON c.file_name = s.file_name
+            WHERE (c.file_size IS DISTINCT FROM s.file_size OR c.file_mtime IS DISTINCT FROM s.file_mtime)
+              AND c.status = 'IN_PROGRESS' AND c.lease_expires > CURRENT_TIMESTAMP
+        """)
+        busy = cur.fetchone()[0]
+
+        reloaded = 0
+        cur.execute("SELECT to_regclass('ghcn_daily_test') IS NOT NULL")
+        if cur.fetchone()[0]:
+            cur.execute(f"""
+                DELETE FROM ghcn_daily_test d
+                USING ghcn_load_control_test c, ghcn_control_scan s
+                WHERE c.file_name = s.file_name
+                  AND (c.file_size IS DISTINCT FROM s.file_size OR c.file_mtime IS DISTINCT FROM s.file_mtime)
+                  AND c.status = 'COMPLETED' AND NOT ({shard})
+                  AND d.station_id = split_part(regexp_replace(c.file_name, '^.*/', ''), '.', 1)
+            """)
+            reloaded = cur.rowcount
+
+        cur.execute(f"""
+            UPDATE ghcn_load_control_test c
+            SET status = 'CHANGED',
+                file_size = s.file_size,
+                file_mtime = s.file_mtime,
+                expected_row_count = s.expected_row_count,
+                error_condition = 'Changed after it was loaded; its rows are still in ghcn_daily_test',
+                last_updated = CURRENT_TIMESTAMP
+            {changed_files}
+              AND c.status IN ('COMPLETED', 'CHANGED') AND {shard}
+        """)
+        flagged = cur.rowcount
+
+        cur.execute(f"""
+            UPDATE ghcn_load_control_test c
+            SET status = 'PENDING',
+                file_size = s.file_size,
+                file_mtime = s.file_mtime,
+                expected_row_count = s.expected_row_count,
+                csv_record_count = NULL,
+                inserted_row_count = NULL,
+                error_condition = NULL,
+                owner = NULL,
+                lease_expires = NULL,
+                heartbeat = NULL,
+                last_updated = CURRENT_TIMESTAMP
+            {changed_files}
+              AND c.status IS DISTINCT FROM 'CHANGED'
+        """)
+        changed = cur.rowcount
+
+        cur.execute("""
+            INSERT INTO ghcn_load_control_test (file_name, status, file_size, file_mtime, expected_row_count)
+            SELECT s.file_name, 'PENDING', s.file_size, s.file_mtime, s.expected_row_count
+            FROM ghcn_control_scan s
+            WHERE NOT EXISTS (SELECT 1 FROM ghcn_load_control_test c WHERE c.file_name = s.file_name)
+        """)
+        inserted = cur.rowcount
+
+        # .dly rows belong to process_ghcn.py --copy, which tracks them itself
+        cur.execute(f"""
+            DELETE FROM ghcn_load_control_test c
+            WHERE c.status IN ('PENDING', 'FAILED')
+              AND ({csv_file})
+              AND NOT EXISTS (SELECT 1 FROM ghcn_control_scan s WHERE s.file_name = c.file_name)
+        """)
+        removed = cur.rowcount
+    conn.commit()
+    return inserted, changed, busy, removed, backfilled, reloaded, flagged
 
 def reset_file_statuses(conn):
     with conn.cursor() as cur:
@@ -64,6 +237,9 @@ def reset_file_statuses(conn):
                 csv_record_count = NULL,
                 inserted_row_count = NULL,
                 error_condition = NULL,
+                owner = NULL,
+                lease_expires = NULL,
+                heartbeat = NULL,
                 last_updated = CURRENT_TIMESTAMP
         """)
         rows_updated = cur.rowcount
@@ -73,6 +249,8 @@ def reset_file_statuses(conn):
 def main():
     parser = argparse.ArgumentParser(description='Setup or reset GHCN control table.')
     parser.add_argument('-r', '--reset', action='store_true', help='Reset all files to PENDING state')
+    parser.add_argument('--full', action='store_true', help='Truncate the control table and register every file again, instead of adding new and changed files')
+    parser.add_argument('--directory', default='/home/gpadmin/data/ghcnd_all/processed_ghcn', help='Directory of processed CSVs to register (default: /home/gpadmin/data/ghcnd_all/processed_ghcn)')
     args = parser.parse_args()
 
     # Connect to the database
@@ -83,16 +261,32 @@ def main():
             # Reset all files to PENDING state
             reset_file_statuses(conn)
         else:
-            # Setup (truncate or create) the control table
-            setup_control_table(conn)
+            # Create the control table if needed (truncating it with --full)
+            setup_control_table(conn, truncate=args.full)
 
-            # Get the list of CSV files from the directory
-            csv_directory = '/home/gpadmin/data/ghcnd_all/processed_ghcn'
-            csv_files = get_csv_files(csv_directory)
+            # Scan the directory of CSV files, with size, mtime and known row counts
+            csv_files = get_csv_files(args.directory)
+            print(f"Found {len(csv_files)} CSV files in {args.directory} "
+                  f"({sum(1 for f in csv_files if f[3] is not None)} with row counts from {OUTPUT_MANIFEST}).")
+            if csv_files and read_csv_header(csv_files[0][0]) != LONG_CSV_HEADER:
+                print(f"Not registering {args.directory}: {os.path.basename(csv_files[0][0])} does not have the "
+                      f"ghcn_daily_test header ({LONG_CSV_HEADER}). Wide CSVs load into ghcn_daily_wide, "
+                      f"e.g. with process_ghcn.py --format wide --copy.")
+                return
 
-            # Insert CSV files into the control table with a progress bar
-            insert_csv_files(conn, csv_files)
-            print(f"Inserted {len(csv_files)} CSV files into ghcn_load_control_test.")
+            inserted, changed, busy, removed, backfilled, reloaded, flagged = insert_csv_files(conn, csv_files)
+            print(f"Registered {inserted} new CSV files and reset {changed} changed ones to PENDING in ghcn_load_control_test.")
+            if backfilled:
+                print(f"Recorded size and mtime for {backfilled} files registered without them, keeping their status.")
+            if reloaded:
+                print(f"Deleted {reloaded} rows of changed, already loaded stations from ghcn_daily_test so they load again.")
+            if flagged:
+                print(f"Marked {flagged} changed, already loaded shards CHANGED: their stations' rows are still in ghcn_daily_test. "
+                      f"Reload them explicitly, e.g. truncate ghcn_daily_test and register again with --full.")
+            if busy:
+                print(f"Left {busy} changed files alone because a loader currently holds their lease; rescan once it is done.")
+            if removed:
+                print(f"Removed {removed} PENDING/FAILED entries whose files no longer exist.")
     finally:
         conn.close()
 
@@ -1,95 +1,169 @@
 #!/usr/bin/env python3
 
-import requests
+import io
+import csv
+import sys
 import argparse
-from tqdm import tqdm  # For progress indicator
+
+STATIONS_URL = 'https://www.ncei.noaa.gov/pub/data/ghcn/daily/ghcnd-stations.txt'
+STATION_COLUMNS = ('station_id', 'latitude', 'longitude', 'elevation', 'state', 'station_name',
+                   'gsn_flag', 'hcn_crn_flag', 'wmo_id')
+
+# weather_stations is small and joined to every observation, so by default
+# each segment keeps a full copy and joins need no motion
+DISTRIBUTIONS = {
+    'replicated': 'DISTRIBUTED REPLICATED',
+    'hash': 'DISTRIBUTED BY (station_id)',
+    'random': 'DISTRIBUTED RANDOMLY',  # no primary key: randomly distributed tables cannot have one
+}
+DEFAULT_DISTRIBUTION = 'replicated'
 
 # Function to create the weather_stations table if it doesn't exist
-def create_table_if_not_exists(db_conn):
-    cursor = db_conn.cursor()
-    create_table_query = """
-    CREATE TABLE IF NOT EXISTS weather_stations (
-        station_id CHAR(11) PRIMARY KEY,
-        latitude DECIMAL(8, 4),
-        longitude DECIMAL(9, 4),
-        elevation DECIMAL(5, 1),
-        state VARCHAR(2),
-        station_name VARCHAR(30),
-        gsn_flag VARCHAR(3),
-        hcn_crn_flag VARCHAR(3),
-        wmo_id VARCHAR(5)
-    );
+def create_table_if_not_exists(db_conn, distribution=None):
     """
-    cursor.execute(create_table_query)
+    Create weather_stations with the given distribution (replicated when
+    none is given). If the table already exists and a distribution is
+    given, redistribute it in place when its policy differs.
+    """
+    cursor = db_conn.cursor()
+    cursor.execute("SELECT to_regclass('weather_stations')")
+    exists = cursor.fetchone()[0] is not None
+
+    if not exists:
+        distribution = distribution or DEFAULT_DISTRIBUTION
+        primary_key = '' if distribution == 'random' else ' PRIMARY KEY'
+        create_table_query = f"""
+        CREATE TABLE weather_stations (
+            station_id CHAR(11){primary_key},
+            latitude DECIMAL(8, 4),
+            longitude DECIMAL(9, 4),
+            elevation DECIMAL(5, 1),
+            state VARCHAR(2),
+            station_name VARCHAR(30),
+            gsn_flag VARCHAR(3),
+            hcn_crn_flag VARCHAR(3),
+            wmo_id VARCHAR(5)
+        ) {DISTRIBUTIONS[distribution]};
+        """
+        cursor.execute(create_table_query)
+        print(f"Created weather_stations {DISTRIBUTIONS[distribution]}.")
+    elif distribution:
+        cursor.execute("SELECT pg_get_table_distributedby('weather_stations'::regclass)")
+        current = cursor.fetchone()[0]
+        if current != DISTRIBUTIONS[distribution]:
+            cursor.execute("""
+                SELECT conname FROM pg_constraint
+                WHERE conrelid = 'weather_stations'::regclass AND contype = 'p'
+            """)
+            primary_key = cursor.fetchone()
+            if distribution == 'random' and primary_key:
+                cursor.execute(f"ALTER TABLE weather_stations DROP CONSTRAINT {primary_key[0]}")
+            cursor.execute(f"ALTER TABLE weather_stations SET {DISTRIBUTIONS[distribution]}")
+            if distribution != 'random' and not primary_key:
+                cursor.execute("ALTER TABLE weather_stations ADD PRIMARY KEY (station_id)")
+            cursor.execute("ANALYZE weather_stations")
+            print(f"Redistributed weather_stations from {current} to {DISTRIBUTIONS[distribution]}.")
     db_conn.commit()
     cursor.close()
 
-# Function to fetch and parse the data
-def fetch_and_parse_data(output=None, to_stdout=False, to_db=False, db_conn=None):
-    # URL of the station text file
-    url = 'https://www.ncei.noaa.gov/pub/data/ghcn/daily/ghcnd-stations.txt'
+# Function to read the station list, from a local copy or from NOAA
+def read_station_lines(from_file=None):
+    if from_file:
+        with open(from_file) as f:
+            return f.read().splitlines()
+
+    # Only import requests when the file has to be fetched
+    import requests
 
     # Fetch the file from the internet
-    response = requests.get(url)
+    response = requests.get(STATIONS_URL)
     if response.status_code != 200:
         print(f"Failed to retrieve the file. Status code: {response.status_code}")
-        exit()
-
-    # Parse the fetched data
-    lines = response.text.splitlines()  # Splitting the file content into lines
-    if to_db:
-        # Initialize tqdm progress bar if writing to DB
-        for line in tqdm(lines, desc="Processing stations", unit="station"):
-            process_line(line, output, to_stdout, to_db, db_conn)
-    else:
-        for line in lines:
-            process_line(line, output, to_stdout, to_db, db_conn)
-
-# Function to process and write a single line of data
-def process_line(line, output, to_stdout, to_db, db_conn):
-    if line.strip():  # Only process non-empty lines
-        station_id = line[0:11].strip()  # ID
-        latitude = float(line[12:20].strip())  # LATITUDE
-        longitude = float(line[21:30].strip())  # LONGITUDE
-        elevation = float(line[31:37].strip())  # ELEVATION
-
-        # Convert elevation of -999.9 to NULL
-        elevation = None if elevation == -999.9 else elevation
-
-        state = line[38:40].strip() if line[38:40].strip() else None  # STATE (can be NULL)
-        station_name = line[41:71].strip()  # NAME (fixed width CHAR(30))
-        gsn_flag = line[72:75].strip() if line[72:75].strip() else None  # GSN FLAG (can be NULL)
-        hcn_crn_flag = line[76:79].strip() if line[76:79].strip() else None  # HCN/CRN FLAG (can be NULL)
-        wmo_id = line[80:85].strip() if line[80:85].strip() else None  # WMO ID (can be NULL)
-
-        # Format the parsed data
-        parsed_data = f"Station ID: {station_id}, Latitude: {latitude}, Longitude: {longitude}, " \
-                      f"Elevation: {elevation}, State: {state}, Name: {station_name}, " \
-                      f"GSN Flag: {gsn_flag}, HCN/CRN Flag: {hcn_crn_flag}, WMO ID: {wmo_id}\n"
-
-        # Write to stdout if specified
-        if to_stdout:
-            output.write(parsed_data)
-
-        # Write to Postgres database
-        if to_db and db_conn:
-            cursor = db_conn.cursor()
-            cursor.execute("""
-                INSERT INTO weather_stations (
-                    station_id, latitude, longitude, elevation, state, station_name,
-                    gsn_flag, hcn_crn_flag, wmo_id
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (station_id) DO NOTHING;
-            """, (station_id, latitude, longitude, elevation, state, station_name, gsn_flag, hcn_crn_flag, wmo_id))
-            db_conn.commit()
+        sys.exit(1)
+    return response.text.splitlines()  # Splitting the file content into lines
+
+# Function to parse a single fixed-width line into a weather_stations row
+def parse_line(line):
+    if not line.strip():  # Only process non-empty lines
+        return None
+    station_id = line[0:11].strip()  # ID
+    latitude = float(line[12:20].strip())  # LATITUDE
+    longitude = float(line[21:30].strip())  # LONGITUDE
+    elevation = float(line[31:37].strip())  # ELEVATION
+
+    # Convert elevation of -999.9 to NULL
+    elevation = None if elevation == -999.9 else elevation
+
+    state = line[38:40].strip() or None  # STATE (can be NULL)
+    station_name = line[41:71].strip()  # NAME (fixed width CHAR(30))
+    gsn_flag = line[72:75].strip() or None  # GSN FLAG (can be NULL)
+    hcn_crn_flag = line[76:79].strip() or None  # HCN/CRN FLAG (can be NULL)
+    wmo_id = line[80:85].strip() or None  # WMO ID (can be NULL)
+    return (station_id, latitude, longitude, elevation, state, station_name, gsn_flag, hcn_crn_flag, wmo_id)
+
+# Function to parse the whole station list in one pass
+def parse_stations(lines):
+    return [station for station in map(parse_line, lines) if station]
+
+# Function to write the parsed stations as text
+def write_stations(stations, output):
+    for (station_id, latitude, longitude, elevation, state, station_name,
+         gsn_flag, hcn_crn_flag, wmo_id) in stations:
+        output.write(f"Station ID: {station_id}, Latitude: {latitude}, Longitude: {longitude}, "
+                     f"Elevation: {elevation}, State: {state}, Name: {station_name}, "
+                     f"GSN Flag: {gsn_flag}, HCN/CRN Flag: {hcn_crn_flag}, WMO ID: {wmo_id}\n")
+
+# Function to load the parsed stations into weather_stations in one transaction
+def load_stations(db_conn, stations):
+    """
+    COPY every station into a temp staging table, then merge set-based:
+    stations whose metadata changed are updated and new stations inserted.
+    Returns (inserted, updated).
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for station in stations:
+        writer.writerow(['' if value is None else value for value in station])
+    buf.seek(0)
+
+    columns = ', '.join(STATION_COLUMNS)
+    changed = ' OR '.join(f"w.{c} IS DISTINCT FROM s.{c}" for c in STATION_COLUMNS[1:])
+    with db_conn.cursor() as cur:
+        cur.execute("""
+            CREATE TEMP TABLE weather_stations_stage (LIKE weather_stations)
+            ON COMMIT DROP DISTRIBUTED BY (station_id)
+        """)
+        cur.copy_expert(f"COPY weather_stations_stage ({columns}) FROM STDIN WITH (FORMAT csv)", buf)
+
+        cur.execute(f"""
+            UPDATE weather_stations w
+            SET {', '.join(f"{c} = s.{c}" for c in STATION_COLUMNS[1:])}
+            FROM weather_stations_stage s
+            WHERE w.station_id = s.station_id
+              AND ({changed})
+        """)
+        updated = cur.rowcount
+
+        cur.execute(f"""
+            INSERT INTO weather_stations ({columns})
+            SELECT {', '.join(f"s.{c}" for c in STATION_COLUMNS)}
+            FROM weather_stations_stage s
+            WHERE NOT EXISTS (SELECT 1 FROM weather_stations w WHERE w.station_id = s.station_id)
+        """)
+        inserted = cur.rowcount
+    db_conn.commit()
+    return inserted, updated
 
 # Main function to handle arguments and logic
 def main():
     parser = argparse.ArgumentParser(description="Parse weather station data and output to file, stdout, or Postgres DB.")
+    parser.add_argument('--from-file', metavar='filename', type=str, help='Read a local copy of ghcnd-stations.txt instead of fetching it from NOAA.')
     parser.add_argument('--to-file', metavar='filename', type=str, help='Write output to the specified file.')
     parser.add_argument('--to-stdout', action='store_true', help='Write output to stdout.')
     parser.add_argument('--to-db', action='store_true', help='Write output to a Postgres database.')
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS,
+                        help=f'Distribution of weather_stations: replicated, hash (by station_id) or random. New tables default to '
+                             f'{DEFAULT_DISTRIBUTION}; an existing table is redistributed only when this is given.')
 
     # Database connection arguments
     parser.add_argument('--db-name', type=str, help='Postgres database name.')
@@ -100,6 +174,10 @@ def main():
 
     args = parser.parse_args()
 
+    if not (args.to_file or args.to_stdout or args.to_db):
+        print("Please specify an output option: --to-file, --to-stdout, or --to-db.")
+        return
+
     db_conn = None
 
     # Handle Postgres connection if --to-db is specified
@@ -110,7 +188,7 @@ def main():
 
             if not all([args.db_name, args.db_user, args.db_password]):
                 print("Database credentials are required when using --to-db.")
-                exit()
+                sys.exit(1)
 
             db_conn = psycopg2.connect(
                 dbname=args.db_name,
@@ -120,31 +198,35 @@ def main():
                 port=args.db_port
             )
 
-            # Create the table if it doesn't exist
-            create_table_if_not_exists(db_conn)
+            # Create the table if it doesn't exist, or redistribute it if asked to
+            create_table_if_not_exists(db_conn, args.distribution)
 
         except ImportError:
             print("psycopg2 is not installed. Install it with 'pip install psycopg2'.")
-            exit()
+            sys.exit(1)
         except Exception as e:
             print(f"Error connecting to the database: {e}")
-            exit()
+            sys.exit(1)
+
+    # Parse the station list once, whichever outputs are requested
+    stations = parse_stations(read_station_lines(args.from_file))
 
     if args.to_file:
         # Write output to the specified file
         with open(args.to_file, 'w') as f:
-            fetch_and_parse_data(f, to_stdout=args.to_stdout, to_db=args.to_db, db_conn=db_conn)
+            write_stations(stations, f)
     elif args.to_stdout:
         # Write output to stdout
-        fetch_and_parse_data(sys.stdout, to_stdout=True, to_db=args.to_db, db_conn=db_conn)
-    elif args.to_db:
-        # Write output to the database
-        fetch_and_parse_data(None, to_stdout=False, to_db=args.to_db, db_conn=db_conn)
-    else:
-        print("Please specify an output option: --to-file, --to-stdout, or --to-db.")
+        write_stations(stations, sys.stdout)
 
     if db_conn:
-        db_conn.close()
+        # Write output to the database
+        try:
+            inserted, updated = load_stations(db_conn, stations)
+            print(f"Loaded {len(stations)} stations: {inserted} new, {updated} updated, "
+                  f"{len(stations) - inserted - updated} unchanged.")
+        finally:
+            db_conn.close()
 
 # Entry point
 if __name__ == '__main__':
@@ -1,83 +1,1103 @@
 #!/usr/bin/env python3
 
 import os
-import pandas as pd
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import io
+import csv
+import json
+import time
+import zlib
+import gzip
+import contextlib
+import importlib.util
+import tarfile
+import urllib.request
+import heapq
+import string
+import argparse
+import resource
+from collections import namedtuple, Counter
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import multiprocessing
 from tqdm import tqdm
 
-def process_dly_file(file_path):
+DEFAULT_DSN = "dbname=climate_analysis user=gpadmin host=mdw"
+# --copy tracks .dly files in its own control table: ghcn_load_control_test
+# holds the CSVs the gpfdist loader claims, and must never list .dly paths
+COPY_CONTROL_TABLE = 'ghcn_copy_control'
+COPY_SQL = "COPY ghcn_daily_test (station_id, observation_date, element, value, mflag, qflag, sflag) FROM STDIN WITH (FORMAT csv)"
+PROCESS_MANIFEST = 'ghcn_process_manifest.json'
+MANIFEST_SAVE_SECONDS = 30
+UNITS_PER_WORKER = 4  # lower bound on work units per worker, see plan_work_units
+SHARD_MANIFEST = 'ghcn_shards.manifest'  # deliberately not *.csv so loaders don't pick it up as data
+# Shards and wide CSVs get their own directories, so they are never
+# registered alongside per-station long CSVs of the same stations (and wide
+# CSVs never reach the loader of the 7-column ghcn_daily_test)
+OUTPUT_DIR = 'processed_ghcn'
+# Sidecar for loaders: file,rows,bytes,checksum for every CSV in the output directory
+OUTPUT_MANIFEST = 'ghcn_output.manifest'
+CSV_HEADER = b"station_id,observation_date,element,value,mflag,qflag,sflag\n"
+
+# --compress: file suffix and level per codec. Both are ones gpfdist
+# decompresses on the fly; the low levels keep compression off the critical path
+COMPRESSION = {'gzip': ('.gz', 1), 'zstd': ('.zst', 3)}
+CSV_SUFFIXES = ('.csv',) + tuple('.csv' + suffix for suffix, _ in COMPRESSION.values())
+
+# Wide format: one row per (station, date) with the core elements as value/qflag column pairs
+WIDE_ELEMENTS = ['TMAX', 'TMIN', 'PRCP', 'SNOW', 'SNWD']
+WIDE_COLUMNS = ['station_id', 'observation_date'] + [column for e in WIDE_ELEMENTS for column in (e.lower(), f"{e.lower()}_qflag")]
+WIDE_CSV_HEADER = (",".join(WIDE_COLUMNS) + "\n").encode()
+WIDE_COPY_SQL = f"COPY ghcn_daily_wide ({', '.join(WIDE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+
+# .dly layout: ID(11) YEAR(4) MONTH(2) ELEMENT(4), then 31 x [VALUE(5) MFLAG QFLAG SFLAG]
+DLY_LINE_LENGTH = 269
+DLY_DAYS = 31
+MISSING_VALUE = -9999
+
+# Fixed-width output row for the numpy engine; unused bytes are zero and get squeezed out
+#   station(11) , YYYY - MM - DD , element(4) , sign+value(6) , m , q , s \n
+ROW_WIDTH = 11 + 1 + 10 + 1 + 4 + 1 + 6 + 1 + 1 + 1 + 1 + 1 + 1 + 1
+DAY_BYTES = np.frombuffer(b"".join(f"{day:02d}".encode() for day in range(1, DLY_DAYS + 1)), dtype=np.uint8).reshape(DLY_DAYS, 2)
+VALUE_PLACES = np.array([10000, 1000, 100, 10, 1], dtype=np.int32)
+#   station(11) , YYYY - MM - DD then per element: , sign+value(6) , qflag, then \n
+WIDE_ROW_WIDTH = 11 + 1 + 10 + len(WIDE_ELEMENTS) * (1 + 6 + 1 + 1) + 1
+
+# elements: frozenset of element codes to keep (None keeps all)
+# drop_qflags: frozenset of QFLAG letters whose observations are dropped
+# compress: None, or a COMPRESSION codec for the CSVs written
+ProcessOptions = namedtuple('ProcessOptions', ['engine', 'buffer_size', 'copy_batch_size', 'output_format', 'elements', 'drop_qflags', 'compress'],
+                            defaults=['numpy', 4 * 1024 * 1024, 64 * 1024 * 1024, 'long', None, frozenset(), None])
+
+# Per-process database connection for --copy mode, opened by init_copy_worker
+worker_conn = None
+
+def keep_observation(element, qflag, options):
+    if options.elements is not None and element not in options.elements:
+        return False
+    return qflag not in options.drop_qflags
+
+def write_rows_legacy(src, out, options, dropped):
+    import pandas as pd  # only the legacy engine needs pandas
+
+    lines = [line.decode() for line in src.readlines()]
+
+    data = []
+    for line in lines:
+        station_id = line[:11]
+        year = int(line[11:15])
+        month = int(line[15:17])
+        element = line[17:21]
+        # Each day has a value, MFLAG, QFLAG, SFLAG (8 characters per day)
+        for day in range(31):
+            value = int(line[21+day*8:26+day*8])
+            mflag = line[26+day*8:27+day*8].strip()
+            qflag = line[27+day*8:28+day*8].strip()
+            sflag = line[28+day*8:29+day*8].strip()
+
+            if value != -9999:  # -9999 indicates missing data
+                if not keep_observation(element, qflag, options):
+                    dropped[element] += 1
+                # Only create a record if the day exists (handle shorter months)
+                elif day + 1 <= 31:
+                    observation_date = f"{year}-{month:02d}-{day+1:02d}"
+                    data.append([station_id, observation_date, element, value, mflag, qflag, sflag])
+
+    df = pd.DataFrame(data, columns=['station_id', 'observation_date', 'element', 'value', 'mflag', 'qflag', 'sflag'])
+    out.write(df.to_csv(index=False, header=False).encode())
+    return len(df)
+
+def dly_records(buf):
+    """
+    View a .dly byte buffer as an (n, 269) uint8 record array.
+
+    Well-formed files are a straight reshape of the buffer; anything else
+    (CRLF endings, a missing final newline) is normalised first. A line
+    shorter than a full record raises ValueError, as in the other engines,
+    rather than being padded into observations.
+    """
+    stride = DLY_LINE_LENGTH + 1
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    if len(raw) % stride == 0 and np.all(raw[DLY_LINE_LENGTH::stride] == ord('\n')):
+        return raw.reshape(-1, stride)[:, :DLY_LINE_LENGTH]
+
+    lines = [line.rstrip(b"\r") for line in buf.split(b"\n") if line.strip()]
+    for line in lines:
+        if len(line) < DLY_LINE_LENGTH:
+            raise ValueError(f"truncated .dly line ({len(line)} of {DLY_LINE_LENGTH} bytes): {line[:21].decode(errors='replace')}")
+    return np.frombuffer(b"".join(line[:DLY_LINE_LENGTH] for line in lines), dtype=np.uint8).reshape(-1, DLY_LINE_LENGTH)
+
+def check_value_fields(text):
+    """
+    Raise ValueError unless every (n, 31, 5) VALUE field is an integer the
+    way int() reads it: optional spaces, an optional "-", digits, optional
+    spaces. Blank or garbled fields must not decode to 0.
+    """
+    is_digit = (text >= ord('0')) & (text <= ord('9'))
+    is_minus = text == ord('-')
+    body = text != ord(' ')
+    width = text.shape[-1]
+    first = np.argmax(body, axis=-1)
+    last = width - 1 - np.argmax(body[..., ::-1], axis=-1)
+    contiguous = body.sum(axis=-1) == last - first + 1
+    sign_first = np.take_along_axis(is_minus, first[..., None], axis=-1)[..., 0]
+    valid = (contiguous & ((is_digit | is_minus | ~body).all(axis=-1))
+             & (is_digit.sum(axis=-1) >= 1)
+             & (is_minus.sum(axis=-1) == sign_first.astype(int)))
+    if not valid.all():
+        line, day = np.argwhere(~valid)[0]
+        raise ValueError(f"{int((~valid).sum())} malformed VALUE fields, first on day {day + 1}: "
+                         f"{bytes(text[line, day]).decode(errors='replace')!r}")
+
+def decode_values(records):
+    """Decode the 31 right-justified VALUE fields of every record into an (n, 31) int array."""
+    slots = records[:, 21:].reshape(-1, DLY_DAYS, 8)
+    text = slots[:, :, :5]
+    check_value_fields(text)
+    is_digit = (text >= ord('0')) & (text <= ord('9'))
+    digits = np.where(is_digit, text.astype(np.int32) - ord('0'), 0)
+    values = digits @ VALUE_PLACES
+    negative = (text == ord('-')).any(axis=2)
+    return np.where(negative, -values, values), slots
+
+def read_record_chunks(src, chunk_size):
+    """Yield buffers of whole .dly lines, roughly chunk_size bytes each."""
+    chunk_size = max(chunk_size, DLY_LINE_LENGTH + 1)
+    carry = b""
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            break
+        data = carry + data
+        cut = data.rfind(b"\n") + 1
+        if cut == 0:
+            carry = data
+            continue
+        carry = data[cut:]
+        yield data[:cut]
+    if carry.strip():
+        yield carry
+
+def write_rows_numpy(src, out, options, dropped):
+    row_count = 0
+    for buf in read_record_chunks(src, options.buffer_size):
+        row_count += write_chunk_numpy(buf, out, options, dropped)
+    return row_count
+
+def element_mask(records, elements):
+    """Boolean per record: is its ELEMENT one of elements?"""
+    mask = np.zeros(len(records), dtype=bool)
+    for element in elements:
+        mask |= np.all(records[:, 17:21] == np.frombuffer(element.encode(), dtype=np.uint8), axis=1)
+    return mask
+
+def observation_mask(records, values, slots, options):
+    """
+    (n, 31) mask of observations to write: present, an allowed element and
+    not carrying a dropped quality flag. Dropped observations are everything
+    present but outside the mask.
+    """
+    keep = values != MISSING_VALUE
+    if options.elements is not None:
+        keep &= element_mask(records, options.elements)[:, None]
+    if options.drop_qflags:
+        codes = np.frombuffer("".join(options.drop_qflags).encode(), dtype=np.uint8)
+        keep &= ~np.isin(slots[:, :, 6], codes)
+    return keep
+
+def count_dropped(records, values, keep, dropped):
+    per_line = ((values != MISSING_VALUE) & ~keep).sum(axis=1)
+    lines = np.nonzero(per_line)[0]
+    if len(lines) == 0:
+        return
+    codes = np.ascontiguousarray(records[lines, 17:21]).view('S4').ravel()
+    names, inverse = np.unique(codes, return_inverse=True)
+    for name, count in zip(names, np.bincount(inverse.ravel(), weights=per_line[lines])):
+        dropped[name.decode()] += int(count)
+
+def render_values(value):
+    """
+    Render integers as zero-padded (m, 6) byte fields: sign then up to five
+    digits. Re-rendering from the integer keeps the text identical to int()
+    (no padding, no leading zeros, "-" only for negatives).
+    """
+    magnitude = np.abs(value)
+    fields = np.zeros((len(value), 6), dtype=np.uint8)
+    fields[:, 0] = np.where(value < 0, ord('-'), 0)
+    value_digits = (magnitude[:, None] // VALUE_PLACES) % 10 + ord('0')
+    leading = magnitude[:, None] < VALUE_PLACES
+    leading[:, -1] = False
+    fields[:, 1:] = np.where(leading, 0, value_digits)
+    return fields
+
+def parse_digits(text):
+    """Parse an (n, k) array of ASCII digits into n integers."""
+    places = 10 ** np.arange(text.shape[1] - 1, -1, -1)
+    return (text.astype(np.int64) - ord('0')) @ places
+
+def write_chunk_numpy(buf, out, options, dropped):
+    records = dly_records(buf)
+    if len(records) == 0:
+        return 0
+
+    values, slots = decode_values(records)
+    keep = observation_mask(records, values, slots, options)
+    count_dropped(records, values, keep, dropped)
+    line_idx, day_idx = np.nonzero(keep)
+    row_count = len(line_idx)
+    if row_count == 0:
+        return 0
+
+    rec = records[line_idx]
+    rows = np.zeros((row_count, ROW_WIDTH), dtype=np.uint8)
+    rows[:, 0:11] = rec[:, 0:11]
+    rows[:, 11] = ord(',')
+    rows[:, 12:16] = rec[:, 11:15]
+    rows[:, 16] = ord('-')
+    rows[:, 17:19] = rec[:, 15:17]
+    rows[:, 19] = ord('-')
+    rows[:, 20:22] = DAY_BYTES[day_idx]
+    rows[:, 22] = ord(',')
+    rows[:, 23:27] = rec[:, 17:21]
+    rows[:, 27] = ord(',')
+
+    rows[:, 28:34] = render_values(values[line_idx, day_idx])
+
+    flags = slots[line_idx, day_idx, 5:8]
+    rows[:, 34] = ord(',')
+    rows[:, 35] = flags[:, 0]
+    rows[:, 36] = ord(',')
+    rows[:, 37] = flags[:, 1]
+    rows[:, 38] = ord(',')
+    rows[:, 39] = flags[:, 2]
+    rows[:, 40] = ord('\n')
+    # Blank flags are stripped, as in the legacy engine
+    flag_cols = rows[:, [35, 37, 39]]
+    flag_cols[flag_cols == ord(' ')] = 0
+    rows[:, [35, 37, 39]] = flag_cols
+
+    out.write(rows[rows != 0].tobytes())
+    return row_count
+
+def write_rows_wide(src, out, options, dropped):
+    """
+    Pivot a station's WIDE_ELEMENTS into one row per observation date.
+
+    The elements for one date can sit on lines anywhere in the file, so the
+    whole station is read at once; the pivoted output is far smaller than
+    the long format. Other elements are counted as dropped.
+    """
+    records = dly_records(src.read())
+    if len(records) == 0:
+        return 0
+    element_idx = np.full(len(records), -1)
+    for i, element in enumerate(WIDE_ELEMENTS):
+        element_idx[element_mask(records, [element])] = i
+
+    values, slots = decode_values(records)
+    keep = observation_mask(records, values, slots, options) & (element_idx >= 0)[:, None]
+    count_dropped(records, values, keep, dropped)
+    line_idx, day_idx = np.nonzero(keep)
+    if len(line_idx) == 0:
+        return 0
+
+    year = parse_digits(records[line_idx, 11:15])
+    month = parse_digits(records[line_idx, 15:17])
+    date_key = (year * 12 + month - 1) * DLY_DAYS + day_idx
+    dates, row_idx = np.unique(date_key, return_inverse=True)
+    row_count = len(dates)
+
+    column = element_idx[line_idx]
+    value_grid = np.full((row_count, len(WIDE_ELEMENTS)), MISSING_VALUE, dtype=np.int64)
+    value_grid[row_idx, column] = values[line_idx, day_idx]
+    qflag_grid = np.zeros((row_count, len(WIDE_ELEMENTS)), dtype=np.uint8)
+    qflag_grid[row_idx, column] = slots[line_idx, day_idx, 6]
+    qflag_grid[qflag_grid == ord(' ')] = 0
+
+    rows = np.zeros((row_count, WIDE_ROW_WIDTH), dtype=np.uint8)
+    rows[:, 0:11] = records[0, 0:11]
+    rows[:, 11] = ord(',')
+    row_year = dates // (12 * DLY_DAYS)
+    rows[:, 12:16] = (row_year[:, None] // VALUE_PLACES[1:]) % 10 + ord('0')
+    rows[:, 16] = ord('-')
+    rows[:, 17:19] = DAY_BYTES[(dates // DLY_DAYS) % 12]
+    rows[:, 19] = ord('-')
+    rows[:, 20:22] = DAY_BYTES[dates % DLY_DAYS]
+    missing = value_grid == MISSING_VALUE
+    for i in range(len(WIDE_ELEMENTS)):
+        base = 22 + i * 9
+        rows[:, base] = ord(',')
+        rows[:, base + 1:base + 7] = np.where(missing[:, i, None], 0, render_values(value_grid[:, i]))
+        rows[:, base + 7] = ord(',')
+        rows[:, base + 8] = qflag_grid[:, i]
+    rows[:, -1] = ord('\n')
+
+    out.write(rows[rows != 0].tobytes())
+    return row_count
+
+def write_rows_stream(src, out, options, dropped):
+    """
+    Line-at-a-time parser that formats CSV text straight into a bounded buffer.
+
+    At most one input line plus options.buffer_size bytes of output are held
+    in memory, however large the station file is.
+    """
+    row_count = 0
+    parts = []
+    buffered = 0
+    for raw in src:
+        line = raw.decode().rstrip('\r\n')
+        if not line.strip():
+            continue
+        prefix = f"{line[:11]},{int(line[11:15])}-{int(line[15:17]):02d}-"
+        element = line[17:21]
+        for day in range(DLY_DAYS):
+            offset = 21 + day * 8
+            value = int(line[offset:offset + 5])
+            if value == MISSING_VALUE:
+                continue
+            qflag = line[offset + 6:offset + 7].strip()
+            if not keep_observation(element, qflag, options):
+                dropped[element] += 1
+                continue
+            row = f"{prefix}{day + 1:02d},{element},{value},{line[offset + 5:offset + 6].strip()},{qflag},{line[offset + 7:offset + 8].strip()}\n"
+            parts.append(row)
+            buffered += len(row)
+            row_count += 1
+        if buffered >= options.buffer_size:
+            out.write("".join(parts).encode())
+            parts = []
+            buffered = 0
+    if parts:
+        out.write("".join(parts).encode())
+    return row_count
+
+ENGINES = {
+    'legacy': write_rows_legacy,
+    'numpy': write_rows_numpy,
+    'stream': write_rows_stream,
+}
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# A station source is either a .dly path on disk or a (member_name, bytes, mtime)
+# tuple read out of the NOAA tarball by the main process.
+def source_name(source):
+    return source[0] if isinstance(source, tuple) else source
+
+def station_id_for(source):
+    return os.path.splitext(os.path.basename(source_name(source)))[0]
+
+def csv_header(options):
+    return WIDE_CSV_HEADER if options.output_format == 'wide' else CSV_HEADER
+
+def write_station(source, out, options, dropped):
+    """Write one station's rows to out; filtered-out observations are tallied in dropped."""
+    write_rows = write_rows_wide if options.output_format == 'wide' else ENGINES[options.engine]
+    if isinstance(source, tuple):
+        return write_rows(io.BytesIO(source[1]), out, options, dropped)
+    with open(source, 'rb', buffering=options.buffer_size) as src:
+        return write_rows(src, out, options, dropped)
+
+class ChecksumWriter:
+    """File wrapper that keeps a running CRC32 and byte count of what is written."""
+
+    def __init__(self, f):
+        self.f = f
+        self.crc = 0
+        self.size = 0
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        return self.f.write(data)
+
+    def flush(self):
+        return self.f.flush()
+
+    def checksum(self):
+        return f"{self.crc:08x}"
+
+def csv_suffix(options):
+    return '.csv' + (COMPRESSION[options.compress][0] if options.compress else '')
+
+def compressed_writer(f, options):
+    """
+    Context manager wrapping the binary file f so everything written through
+    it is compressed with options.compress; f itself is left open.
+    """
+    if options.compress == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=COMPRESSION['gzip'][1], mtime=0)
+    if options.compress == 'zstd':
+        import zstandard  # optional dependency, only needed for --compress zstd
+        return zstandard.ZstdCompressor(level=COMPRESSION['zstd'][1]).stream_writer(f, closefd=False)
+    return contextlib.nullcontext(f)
+
+def file_checksum(path, chunk_size=1024 * 1024):
+    crc = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            crc = zlib.crc32(chunk, crc)
+    return f"{crc:08x}"
+
+def source_stat(source):
+    if isinstance(source, tuple):
+        return len(source[1]), source[2]
+    st = os.stat(source)
+    return st.st_size, int(st.st_mtime)
+
+def source_size(source):
+    return len(source[1]) if isinstance(source, tuple) else os.path.getsize(source)
+
+def source_checksum(source):
+    if isinstance(source, tuple):
+        return f"{zlib.crc32(source[1]):08x}"
+    return file_checksum(source)
+
+def load_process_manifest(output_dir):
+    path = os.path.join(output_dir, PROCESS_MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_process_manifest(output_dir, manifest):
+    # Write-then-rename so an interrupted save never leaves a torn manifest
+    path = os.path.join(output_dir, PROCESS_MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+    write_output_manifest(output_dir, [(entry['output']['file'], entry['output']['rows'], entry['output']['size'], entry['output']['checksum'])
+                                       for entry in manifest.values()])
+
+def write_output_manifest(output_dir, outputs):
+    """
+    Write the loader sidecar from (file, rows, bytes, checksum) tuples, so
+    loaders know each CSV's row count without rescanning it.
+    """
+    path = os.path.join(output_dir, OUTPUT_MANIFEST)
+    with open(path + '.tmp', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['file', 'rows', 'bytes', 'checksum'])
+        writer.writerows(sorted(outputs))
+    os.replace(path + '.tmp', path)
+
+def filter_signature(options):
+    """Stable description of the parse-time filters, recorded with each output."""
+    elements = ",".join(sorted(options.elements)) if options.elements is not None else "*"
+    return f"elements={elements};drop_qflags={''.join(sorted(options.drop_qflags))}"
+
+def station_is_current(entry, size, mtime, output_dir, output_format='long', filters=None, verify=False, compress=None, checksum=None):
+    """
+    A station is up to date when its input still has the recorded size and
+    mtime and its CSV is present, in the requested format, compression and
+    with the same filters, at the recorded size. With verify, the output
+    checksum is recomputed as well.
+
+    An input whose size matches but whose mtime changed (e.g. the same
+    archive extracted again) is compared by content: checksum() is the
+    input's CRC32, and if it matches the recorded one the entry's mtime is
+    refreshed instead of reprocessing the station.
+    """
+    if not entry or entry['input']['size'] != size:
+        return False
+    if entry['input']['mtime'] != mtime:
+        if checksum is None or checksum() != entry['input']['checksum']:
+            return False
+        entry['input']['mtime'] = mtime
+    if entry['output'].get('format', 'long') != output_format or entry['output'].get('filters') != filters:
+        return False
+    if entry['output'].get('compress') != compress:
+        return False
+    output_file = os.path.join(output_dir, entry['output']['file'])
+    if not os.path.exists(output_file) or os.path.getsize(output_file) != entry['output']['size']:
+        return False
+    if verify:
+        return file_checksum(output_file) == entry['output']['checksum']
+    return True
+
+def finish_task(result, started, sources):
+    """Stamp a worker task result with its wall time, input bytes and peak RSS."""
+    result['seconds'] = time.time() - started
+    result['input_bytes'] = sum(source_size(source) for source in sources)
+    result['max_rss_kb'] = peak_rss_kb()
+    return result
+
+def plan_work_units(file_paths, unit_bytes, workers=1):
+    """
+    Group files into work units of about unit_bytes each, largest files first,
+    so the big stations start early and small ones fill in at the end instead
+    of leaving one worker straggling. Units are capped at
+    1/UNITS_PER_WORKER of each worker's share of the bytes, so a small or
+    incremental run still spreads over every worker.
+    """
+    sized = sorted(((os.path.getsize(f), f) for f in file_paths), reverse=True)
+    total_bytes = sum(size for size, _ in sized)
+    unit_bytes = max(1, min(unit_bytes, total_bytes // (workers * UNITS_PER_WORKER)))
+    units = []
+    unit = []
+    unit_size = 0
+    for size, file_path in sized:
+        if unit and unit_size + size > unit_bytes:
+            units.append(unit)
+            unit = []
+            unit_size = 0
+        unit.append(file_path)
+        unit_size += size
+    if unit:
+        units.append(unit)
+    return units
+
+def process_dly_file(source, output_dir, options=ProcessOptions()):
+    """
+    Convert one station to <station>.csv (.csv.gz/.csv.zst with
+    options.compress). The CSV is written as <name>.tmp and renamed into
+    place once the station has parsed, so a failure never leaves a partial
+    CSV for loaders to pick up. The result carries a manifest entry
+    describing the input and output it was built from.
+    """
+    result = {'file': source_name(source), 'ok': False, 'rows': 0, 'pid': os.getpid(), 'dropped': Counter()}
+    output_name = f"{station_id_for(source)}{csv_suffix(options)}"
+    output_path = os.path.join(output_dir, output_name)
     try:
-        with open(file_path, 'r') as f:
-            lines = f.readlines()
-
-        data = []
-        for line in lines:
-            station_id = line[:11]
-            year = int(line[11:15])
-            month = int(line[15:17])
-            element = line[17:21]
-            # Each day has a value, MFLAG, QFLAG, SFLAG (8 characters per day)
-            for day in range(31):
-                value = int(line[21+day*8:26+day*8])
-                mflag = line[26+day*8:27+day*8].strip()
-                qflag = line[27+day*8:28+day*8].strip()
-                sflag = line[28+day*8:29+day*8].strip()
-
-                if value != -9999:  # -9999 indicates missing data
-                    # Only create a record if the day exists (handle shorter months)
-                    if day + 1 <= 31:
-                        observation_date = f"{year}-{month:02d}-{day+1:02d}"
-                        data.append([station_id, observation_date, element, value, mflag, qflag, sflag])
-
-        df = pd.DataFrame(data, columns=['station_id', 'observation_date', 'element', 'value', 'mflag', 'qflag', 'sflag'])
-        output_file = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(file_path))[0]}.csv")
-        df.to_csv(output_file, index=False)
-        return True
+        dropped = Counter()
+        with open(output_path + '.tmp', 'wb') as f:
+            # Size and checksum are of the file as stored, i.e. compressed
+            out = ChecksumWriter(f)
+            with compressed_writer(out, options) as csv_out:
+                csv_out.write(csv_header(options))
+                result['rows'] = write_station(source, csv_out, options, dropped)
+        os.replace(output_path + '.tmp', output_path)
+        result['ok'] = True
+        result['dropped'] = dropped
+        size, mtime = source_stat(source)
+        result['manifest'] = {station_id_for(source): {
+            'input': {'name': source_name(source), 'size': size, 'mtime': mtime, 'checksum': source_checksum(source)},
+            'output': {'file': output_name, 'format': options.output_format, 'filters': filter_signature(options), 'compress': options.compress, 'size': out.size, 'checksum': out.checksum(), 'rows': result['rows']},
+        }}
     except Exception as e:
-        print(f"Error processing file {file_path}: {str(e)}")
-        return False
+        print(f"Error processing file {source_name(source)}: {str(e)}")
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(output_path + '.tmp')
+    result['max_rss_kb'] = peak_rss_kb()
+    return result
+
+def process_dly_batch(sources, output_dir, options=ProcessOptions()):
+    """Run process_dly_file over a batch of sources and merge the results."""
+    started = time.time()
+    result = {'file': None, 'ok': True, 'rows': 0, 'pid': os.getpid(), 'manifest': {}, 'dropped': Counter()}
+    for source in sources:
+        file_result = process_dly_file(source, output_dir, options)
+        result['ok'] = result['ok'] and file_result['ok']
+        result['rows'] += file_result['rows']
+        result['dropped'].update(file_result['dropped'])
+        result['manifest'].update(file_result.get('manifest', {}))
+    return finish_task(result, started, sources)
+
+def open_tarball(location):
+    """Open a local path or http(s)/ftp URL to ghcnd_all.tar.gz as a stream."""
+    if '://' in location:
+        return urllib.request.urlopen(location)
+    return open(location, 'rb')
+
+def iter_tar_batches(fileobj, batch_bytes, skip):
+    """
+    Stream .dly members out of a (compressed) tar in a single forward pass,
+    yielding lists of (member_name, bytes, mtime) of roughly batch_bytes each.
+    Members for which skip(name, size, mtime) is true are never read.
+    """
+    batch = []
+    batched = 0
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith('.dly') or skip(member.name, member.size, int(member.mtime)):
+                continue
+            data = tar.extractfile(member).read()
+            batch.append((member.name, data, int(member.mtime)))
+            batched += len(data)
+            if batched >= batch_bytes:
+                yield batch
+                batch = []
+                batched = 0
+    if batch:
+        yield batch
+
+def shard_file_name(shard_index, options=ProcessOptions()):
+    return f"ghcn_shard_{shard_index:04d}{csv_suffix(options)}"
+
+def output_directory(output_format='long', shards=False):
+    """processed_ghcn, with _wide and/or _shards appended for those layouts."""
+    return OUTPUT_DIR + ('_wide' if output_format == 'wide' else '') + ('_shards' if shards else '')
+
+def remove_stale_shards(output_dir):
+    """Shards are rebuilt as a whole: drop every shard (and .tmp) a previous run left, whatever its --shards count."""
+    removed = 0
+    for entry in os.scandir(output_dir):
+        if entry.name.startswith('ghcn_shard_') and entry.name.endswith(CSV_SUFFIXES + tuple(s + '.tmp' for s in CSV_SUFFIXES)):
+            os.remove(entry.path)
+            removed += 1
+    return removed
+
+def plan_shards(file_paths, num_shards):
+    """
+    Greedy size balancing: hand each file, largest first, to the shard with
+    the fewest bytes so far. Returns a list of file lists, one per shard.
+    """
+    sized = sorted(((os.path.getsize(f), f) for f in file_paths), reverse=True)
+    heap = [(0, i) for i in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    for size, file_path in sized:
+        total, i = heapq.heappop(heap)
+        shards[i].append(file_path)
+        heapq.heappush(heap, (total + size, i))
+    return shards
+
+def process_shard(shard_index, file_paths, output_dir, options=ProcessOptions()):
+    """
+    Write every station in file_paths to a single shard CSV with one header.
+    A station that fails is truncated back out of the shard and left out of
+    the returned station row counts. A compressed stream can't be truncated,
+    so with options.compress each station is buffered until it has parsed.
+    """
+    started = time.time()
+    shard_name = shard_file_name(shard_index, options)
+    shard_path = os.path.join(output_dir, shard_name)
+    result = {'file': shard_name, 'ok': False, 'rows': 0, 'pid': os.getpid(), 'stations': [], 'dropped': Counter()}
+    try:
+        with open(shard_path + '.tmp', 'wb') as f, compressed_writer(f, options) as out:
+            out.write(csv_header(options))
+            for file_path in file_paths:
+                station_out = io.BytesIO() if options.compress else out
+                start = out.tell() if not options.compress else 0
+                dropped = Counter()
+                try:
+                    rows = write_station(file_path, station_out, options, dropped)
+                except Exception as e:
+                    print(f"Error processing file {file_path}: {str(e)}")
+                    if not options.compress:
+                        out.seek(start)
+                        out.truncate()
+                    continue
+                if options.compress:
+                    out.write(station_out.getbuffer())
+                result['stations'].append((station_id_for(file_path), rows))
+                result['rows'] += rows
+                result['dropped'].update(dropped)
+        os.replace(shard_path + '.tmp', shard_path)
+        # Failed stations were truncated out, so checksum the finished file
+        result['bytes'] = os.path.getsize(shard_path)
+        result['checksum'] = file_checksum(shard_path)
+        result['ok'] = True
+    except Exception as e:
+        print(f"Error writing shard {shard_name}: {str(e)}")
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(shard_path + '.tmp')
+    return finish_task(result, started, file_paths)
+
+def write_shard_manifest(output_dir, results):
+    manifest_path = os.path.join(output_dir, SHARD_MANIFEST)
+    with open(manifest_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['station_id', 'shard_file', 'row_count'])
+        for result in sorted(results, key=lambda r: r['file']):
+            for station_id, rows in result['stations']:
+                writer.writerow([station_id, result['file'], rows])
+    return manifest_path
+
+def print_dropped_report(dropped_by_element):
+    print(f"\nRows dropped at parse time: {sum(dropped_by_element.values())}")
+    for element, count in dropped_by_element.most_common():
+        print(f"  {element}: {count}")
+
+def print_worker_report(worker_stats, wall_seconds, num_workers):
+    print("\nPer-worker throughput and memory usage:")
+    busy_total = 0.0
+    for pid, stats in sorted(worker_stats.items()):
+        busy = stats['seconds']
+        busy_total += busy
+        mb_per_s = stats['input_bytes'] / busy / (1024 * 1024) if busy else 0.0
+        rows_per_s = stats['rows'] / busy if busy else 0.0
+        print(f"  worker {pid}: {stats['units']} units, {stats['files']} files, {stats['rows']} rows, "
+              f"busy {busy:.1f}s, {mb_per_s:.1f} MB/s in, {rows_per_s:,.0f} rows/s, peak RSS {stats['max_rss_kb'] / 1024:.1f} MB")
+    if wall_seconds > 0:
+        # Low utilisation means workers are waiting on I/O or on the scheduler,
+        # so adding workers won't help; near 100% means they are CPU-bound
+        print(f"  worker utilisation: {busy_total / (wall_seconds * num_workers):.0%} of {num_workers} workers over {wall_seconds:.1f}s wall time")
+
+def init_copy_worker(dsn):
+    global worker_conn
+    import psycopg2
+    worker_conn = psycopg2.connect(dsn)
+
+def copy_target(options):
+    """Table a --copy run loads into, and its COPY statement."""
+    return ('ghcn_daily_wide', WIDE_COPY_SQL) if options.output_format == 'wide' else ('ghcn_daily_test', COPY_SQL)
+
+def flush_copy_batch(conn, buf, stations, options=ProcessOptions()):
+    """
+    COPY the buffered rows and mark their stations COMPLETED in the same
+    transaction, so a station is either fully loaded and recorded or not at all.
+    Stations loaded before under other filters have their old rows deleted first.
+    """
+    target, copy_sql = copy_target(options)
+    file_names = [file_name for file_name, _ in stations]
+    buf.seek(0)
+    with conn.cursor() as cur:
+        # filters is only set on completion, so it marks stations whose rows are already in target
+        cur.execute(f"""
+            DELETE FROM {target} t
+            USING {COPY_CONTROL_TABLE} c, unnest(%s::text[], %s::text[]) AS u(file_name, station_id)
+            WHERE c.file_name = u.file_name AND c.target_table = %s AND c.filters IS NOT NULL
+              AND t.station_id = u.station_id
+        """, (file_names, [station_id_for(file_name) for file_name in file_names], target))
+        cur.copy_expert(copy_sql, buf)
+        cur.execute(f"""
+            UPDATE {COPY_CONTROL_TABLE} c
+            SET status = 'COMPLETED', filters = %s, csv_record_count = u.rows, inserted_row_count = u.rows,
+                error_condition = NULL, last_updated = CURRENT_TIMESTAMP
+            FROM unnest(%s::text[], %s::int[]) AS u(file_name, rows)
+            WHERE c.file_name = u.file_name AND c.target_table = %s
+        """, (filter_signature(options), file_names, [rows for _, rows in stations], target))
+    conn.commit()
+    buf.seek(0)
+    buf.truncate()
+
+def mark_copy_files(conn, file_names, status, target, error=None):
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE {COPY_CONTROL_TABLE}
+            SET status = %s, error_condition = %s, last_updated = CURRENT_TIMESTAMP
+            WHERE file_name = ANY(%s::text[]) AND target_table = %s
+        """, (status, error, list(file_names), target))
+    conn.commit()
+
+def copy_dly_files(sources, options=ProcessOptions()):
+    """
+    Parse stations straight into ghcn_daily_test (ghcn_daily_wide for the
+    wide format) over this worker's own connection, committing a COPY every
+    options.copy_batch_size bytes.
+    """
+    conn = worker_conn
+    target, _ = copy_target(options)
+    result = {'file': None, 'ok': True, 'rows': 0, 'pid': os.getpid(), 'stations': 0, 'dropped': Counter()}
+    buf = io.BytesIO()
+    pending = []
+    started = time.time()
+    mark_copy_files(conn, [source_name(source) for source in sources], 'IN_PROGRESS', target)
+
+    def flush():
+        try:
+            flush_copy_batch(conn, buf, pending, options)
+            result['rows'] += sum(rows for _, rows in pending)
+            result['stations'] += len(pending)
+        except Exception as e:
+            print(f"Error copying batch of {len(pending)} stations: {str(e)}")
+            conn.rollback()
+            mark_copy_files(conn, [file_name for file_name, _ in pending], 'FAILED', target, str(e))
+            result['ok'] = False
+            buf.seek(0)
+            buf.truncate()
+        pending.clear()
+
+    for source in sources:
+        start = buf.tell()
+        dropped = Counter()
+        try:
+            rows = write_station(source, buf, options, dropped)
+        except Exception as e:
+            print(f"Error processing file {source_name(source)}: {str(e)}")
+            buf.seek(start)
+            buf.truncate()
+            mark_copy_files(conn, [source_name(source)], 'FAILED', target, str(e))
+            result['ok'] = False
+            continue
+        pending.append((source_name(source), rows))
+        result['dropped'].update(dropped)
+        if buf.tell() >= options.copy_batch_size:
+            flush()
+    if pending:
+        flush()
+
+    return finish_task(result, started, sources)
+
+def setup_copy_control_table(conn):
+    """
+    Create ghcn_copy_control if needed, with one row per .dly file and target
+    table. .dly rows that earlier versions registered in ghcn_load_control_test
+    are moved over, so the gpfdist loader can no longer claim them.
+    """
+    default_filters = filter_signature(ProcessOptions())
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {COPY_CONTROL_TABLE} (
+                file_name VARCHAR(255),
+                target_table VARCHAR(63) NOT NULL DEFAULT 'ghcn_daily_test',
+                status VARCHAR(20),
+                filters TEXT,                -- filter_signature() of the completed load
+                csv_record_count INTEGER,
+                inserted_row_count INTEGER,
+                error_condition TEXT,
+                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (file_name, target_table)
+            )
+        """)
+        cur.execute(f"""
+            SELECT EXISTS (
+                SELECT FROM information_schema.columns
+                WHERE table_name = '{COPY_CONTROL_TABLE}' AND column_name = 'target_table'
+            )
+        """)
+        if not cur.fetchone()[0]:
+            # Earlier versions kept one row per .dly file, for ghcn_daily_test loads without filters
+            cur.execute(f"""
+                ALTER TABLE {COPY_CONTROL_TABLE}
+                    ADD COLUMN target_table VARCHAR(63) NOT NULL DEFAULT 'ghcn_daily_test',
+                    ADD COLUMN filters TEXT
+            """)
+            cur.execute(f"UPDATE {COPY_CONTROL_TABLE} SET filters = %s WHERE status = 'COMPLETED'", (default_filters,))
+            cur.execute(f"""
+                ALTER TABLE {COPY_CONTROL_TABLE}
+                    DROP CONSTRAINT {COPY_CONTROL_TABLE}_pkey,
+                    ADD PRIMARY KEY (file_name, target_table)
+            """)
+        cur.execute("SELECT to_regclass('ghcn_load_control_test')")
+        if cur.fetchone()[0] is not None:
+            cur.execute(f"""
+                INSERT INTO {COPY_CONTROL_TABLE} (file_name, status, filters, csv_record_count, inserted_row_count, error_condition, last_updated)
+                SELECT file_name, status, CASE WHEN status = 'COMPLETED' THEN %s END,
+                       csv_record_count, inserted_row_count, error_condition, last_updated
+                FROM ghcn_load_control_test l
+                WHERE l.file_name LIKE '%%.dly'
+                  AND NOT EXISTS (SELECT 1 FROM {COPY_CONTROL_TABLE} c WHERE c.file_name = l.file_name AND c.target_table = 'ghcn_daily_test')
+            """, (default_filters,))
+            cur.execute("DELETE FROM ghcn_load_control_test WHERE file_name LIKE '%.dly'")
+            if cur.rowcount:
+                print(f"Moved {cur.rowcount} .dly entries from ghcn_load_control_test to {COPY_CONTROL_TABLE}.")
+    conn.commit()
+
+def register_control_files(conn, file_names, target):
+    """Add any file names missing from ghcn_copy_control for target as PENDING."""
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            INSERT INTO {COPY_CONTROL_TABLE} (file_name, target_table, status)
+            SELECT f, %s, 'PENDING'
+            FROM unnest(%s::text[]) AS f
+            WHERE NOT EXISTS (SELECT 1 FROM {COPY_CONTROL_TABLE} c WHERE c.file_name = f AND c.target_table = %s)
+        """, (target, file_names, target))
+        registered = cur.rowcount
+    conn.commit()
+    return registered
+
+def completed_control_files(conn, target):
+    """{file_name: filters} for the files completed into target."""
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT file_name, filters FROM {COPY_CONTROL_TABLE} WHERE status = 'COMPLETED' AND target_table = %s", (target,))
+        return dict(cur.fetchall())
 
 def main():
-    global output_dir
-    output_dir = 'processed_ghcn'
-    os.makedirs(output_dir, exist_ok=True)
+    parser = argparse.ArgumentParser(description='Convert GHCN-Daily .dly files to CSV.')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='numpy', help='Parser engine (default: numpy; legacy is the original pure-Python/pandas parser, stream is a line-at-a-time writer)')
+    parser.add_argument('--format', dest='output_format', choices=['long', 'wide'], default='long', help=f'long: one row per observation (default); wide: one row per station and date with TMAX/TMIN/PRCP/SNOW/SNWD columns, for ghcn_daily_wide, written to {output_directory("wide")}')
+    parser.add_argument('--elements', help='Comma-separated element allow-list, e.g. TMAX,TMIN,PRCP,SNOW,SNWD (default: all elements)')
+    parser.add_argument('--drop-qflags', metavar='FLAGS', default='', help='Drop observations whose QFLAG is one of these letters (e.g. DGIKLMNORSTWXZ), or "any" to drop every flagged value')
+    parser.add_argument('--shards', type=int, default=0, help=f'Pack stations into this many size-balanced shard CSVs plus a station manifest, written to {output_directory(shards=True)} instead of one CSV per station')
+    parser.add_argument('--copy', action='store_true', help='Load rows straight into ghcn_daily_test with COPY FROM STDIN (one connection per worker) instead of writing CSVs')
+    parser.add_argument('--copy-batch-mb', type=int, default=64, help='Rows buffered per COPY/commit in --copy mode, in MB (default: 64)')
+    parser.add_argument('--dsn', default=DEFAULT_DSN, help=f'Database connection string for --copy mode (default: "{DEFAULT_DSN}")')
+    parser.add_argument('--tarball', metavar='PATH_OR_URL', help='Stream .dly members straight out of ghcnd_all.tar.gz (local path or URL) instead of reading the current directory')
+    parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count() - 1), help='Worker processes (default: CPU count - 1)')
+    parser.add_argument('--unit-mb', type=int, default=64, help='Target .dly bytes per work unit (or --tarball member batch) handed to a worker, in MB (default: 64)')
+    parser.add_argument('--compress', choices=sorted(COMPRESSION), help='Write gzip (.csv.gz) or zstd (.csv.zst, needs the zstandard package) CSVs, which gpfdist decompresses while serving')
+    parser.add_argument('--verify', action='store_true', help='Recompute output checksums when deciding whether a station is up to date')
+    parser.add_argument('--buffer-mb', type=int, default=4, help='Per-worker read/write buffer ceiling in MB for the numpy and stream engines (default: 4)')
+    args = parser.parse_args()
+    if args.buffer_mb < 1:
+        parser.error('--buffer-mb must be at least 1')
+    if args.workers < 1 or args.unit_mb < 1:
+        parser.error('--workers and --unit-mb must be at least 1')
+    if args.shards < 0:
+        parser.error('--shards must not be negative')
+    if args.output_format == 'wide' and args.engine != 'numpy':
+        parser.error('--format wide is built on the numpy parser and needs --engine numpy')
+    if args.copy and args.shards:
+        parser.error('--copy and --shards are mutually exclusive')
+    if args.tarball and args.shards:
+        parser.error('--shards needs every station size up front and cannot be combined with --tarball')
+    if args.copy and args.compress:
+        parser.error('--compress applies to CSV output and cannot be combined with --copy')
+    if args.compress == 'zstd' and importlib.util.find_spec('zstandard') is None:
+        parser.error('--compress zstd needs the zstandard package (pip install zstandard)')
+
+    elements = frozenset(e.strip().upper() for e in args.elements.split(',') if e.strip()) if args.elements else None
+    drop_qflags = frozenset(string.ascii_uppercase if args.drop_qflags.lower() == 'any' else args.drop_qflags.upper())
+    options = ProcessOptions(engine=args.engine, buffer_size=args.buffer_mb * 1024 * 1024, copy_batch_size=args.copy_batch_mb * 1024 * 1024,
+                             output_format=args.output_format, elements=elements, drop_qflags=drop_qflags, compress=args.compress)
+    dropped_by_element = Counter()
+    worker_stats = {}
+    shard_results = []
 
-    # Get list of .dly files
-    dly_files = [f for f in os.listdir('.') if f.endswith('.dly')]
+    output_dir = output_directory(args.output_format, bool(args.shards))
+    if not args.copy:
+        os.makedirs(output_dir, exist_ok=True)
 
-    # Filter files that don't have a corresponding CSV
-    files_to_process = [
-        f for f in dly_files
-        if not os.path.exists(os.path.join(output_dir, f"{os.path.splitext(f)[0]}.csv"))
-    ]
+    num_cores = args.workers
 
-    total_files = len(files_to_process)
+    control_conn = None
+    completed = {}
+    if args.copy:
+        import psycopg2
+        control_conn = psycopg2.connect(args.dsn)
+        setup_copy_control_table(control_conn)
+        # Resume from the control table rather than from CSVs on disk
+        completed = completed_control_files(control_conn, copy_target(options)[0])
 
-    # Determine the number of cores to use (leaving one core free)
-    num_cores = max(1, multiprocessing.cpu_count() - 1)
+    # Per-station CSV mode is incremental: a station is redone when its input
+    # changed or its CSV is missing or incomplete, per the persistent manifest
+    manifest = {} if args.copy or args.shards else load_process_manifest(output_dir)
+    last_manifest_save = time.time()
 
-    print(f"Found {len(dly_files)} .dly files.")
-    print(f"{total_files} files need processing.")
-    print(f"Using {num_cores} cores for processing.")
+    def already_done(name, size=None, mtime=None):
+        if args.copy:
+            # Loaded into this target with other filters counts as not done
+            return completed.get(name) == filter_signature(options)
+        if size is None:
+            size, mtime = source_stat(name)
+            checksum = lambda: source_checksum(name)
+        else:
+            checksum = None  # a tarball member isn't read unless it is processed
+        return station_is_current(manifest.get(station_id_for(name)), size, mtime, output_dir, args.output_format, filter_signature(options), args.verify, args.compress, checksum)
 
+    if args.tarball:
+        dly_files = None
+        files_to_process = None
+        total_files = None
+        print(f"Streaming .dly members from {args.tarball}.")
+    else:
+        # Get list of .dly files
+        dly_files = [f for f in os.listdir('.') if f.endswith('.dly')]
+
+        if args.copy:
+            dly_paths = [os.path.abspath(f) for f in dly_files]
+            registered = register_control_files(control_conn, dly_paths, copy_target(options)[0])
+            print(f"Registered {registered} new .dly files in {COPY_CONTROL_TABLE} for {copy_target(options)[0]}.")
+            files_to_process = [f for f in dly_paths if not already_done(f)]
+        elif args.shards:
+            # Shards are rebuilt as a whole, so every station is reprocessed
+            files_to_process = dly_files
+        else:
+            # Filter files whose CSV is missing, incomplete or out of date
+            files_to_process = [f for f in dly_files if not already_done(f)]
+
+        total_files = len(files_to_process)
+        print(f"Found {len(dly_files)} .dly files.")
+        print(f"{total_files} files need processing.")
+
+    print(f"Using {num_cores} cores for processing ({args.engine} engine).")
+
+    def record(result, units, pbar):
+        nonlocal last_manifest_save
+        stats = worker_stats.setdefault(result['pid'], {'units': 0, 'files': 0, 'rows': 0, 'input_bytes': 0, 'seconds': 0.0, 'max_rss_kb': 0})
+        stats['units'] += 1
+        stats['files'] += units
+        stats['rows'] += result['rows']
+        stats['input_bytes'] += result['input_bytes']
+        stats['seconds'] += result['seconds']
+        stats['max_rss_kb'] = max(stats['max_rss_kb'], result['max_rss_kb'])
+        dropped_by_element.update(result['dropped'])
+        if args.shards:
+            shard_results.append(result)
+        if 'manifest' in result:
+            for station_id, entry in result['manifest'].items():
+                # A station rewritten under another suffix (compression
+                # changed) must not leave its old CSV behind for loaders
+                old_entry = manifest.get(station_id)
+                if old_entry and old_entry['output']['file'] != entry['output']['file']:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(os.path.join(output_dir, old_entry['output']['file']))
+            manifest.update(result['manifest'])
+            if time.time() - last_manifest_save >= MANIFEST_SAVE_SECONDS:
+                save_process_manifest(output_dir, manifest)
+                last_manifest_save = time.time()
+        pbar.update(units)
+
+    executor_args = {'initializer': init_copy_worker, 'initargs': (args.dsn,)} if args.copy else {}
+    start_time = time.time()
     try:
-        with ProcessPoolExecutor(max_workers=num_cores) as executor:
-            futures = [executor.submit(process_dly_file, filename) for filename in files_to_process]
+        with ProcessPoolExecutor(max_workers=num_cores, **executor_args) as executor, \
+                tqdm(total=total_files, desc="Processing Progress", unit="file") as pbar:
+            if args.tarball:
+                # Keep a bounded number of member batches in flight so the
+                # tarball is never read much faster than it is processed
+                in_flight = {}
+                with open_tarball(args.tarball) as fileobj:
+                    for batch in iter_tar_batches(fileobj, args.unit_mb * 1024 * 1024, already_done):
+                        if args.copy:
+                            register_control_files(control_conn, [name for name, _, _ in batch], copy_target(options)[0])
+                            future = executor.submit(copy_dly_files, batch, options)
+                        else:
+                            future = executor.submit(process_dly_batch, batch, output_dir, options)
+                        in_flight[future] = len(batch)
+                        if len(in_flight) >= 2 * num_cores:
+                            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                record(future.result(), in_flight.pop(future), pbar)
+                for future in as_completed(in_flight):
+                    record(future.result(), in_flight[future], pbar)
+            else:
+                if args.shards:
+                    shards = plan_shards(files_to_process, args.shards)
+                    stale = remove_stale_shards(output_dir)
+                    print(f"Packing stations into {len(shards)} shards in {output_dir}" + (f" (removed {stale} shards from an earlier run)." if stale else "."))
+                    futures = {executor.submit(process_shard, i, shard, output_dir, options): len(shard) for i, shard in enumerate(shards)}
+                else:
+                    # Units are submitted largest first; each is one task, so a
+                    # worker handles many stations per round trip
+                    units = plan_work_units(files_to_process, args.unit_mb * 1024 * 1024, num_cores)
+                    print(f"Scheduling {len(units)} work units for {num_cores} workers (up to {args.unit_mb} MB each).")
+                    task = copy_dly_files if args.copy else process_dly_batch
+                    task_args = () if args.copy else (output_dir,)
+                    futures = {executor.submit(task, unit, *task_args, options): len(unit) for unit in units}
 
-            with tqdm(total=total_files, desc="Processing Progress", unit="file") as pbar:
                 for future in as_completed(futures):
-                    result = future.result()
-                    pbar.update(1)
+                    record(future.result(), futures[future], pbar)
 
     except KeyboardInterrupt:
-        print("\nProcessing interrupted. Progress saved in individual CSV files.")
+        if args.copy:
+            print(f"\nProcessing interrupted. Progress saved in {COPY_CONTROL_TABLE}.")
+        else:
+            print("\nProcessing interrupted. Progress saved in individual CSV files.")
 
     finally:
-        processed_count = len([f for f in os.listdir(output_dir) if f.endswith('.csv')])
-        print(f"\nProcessed data saved to {output_dir}")
-        print(f"Total files processed: {processed_count}")
-        print(f"Files remaining: {len(dly_files) - processed_count}")
+        if control_conn:
+            control_conn.close()
+
+        if args.copy:
+            print("\nRows loaded per worker (parse + COPY):")
+            for pid, stats in sorted(worker_stats.items()):
+                seconds = stats['seconds']
+                rate = stats['rows'] / seconds if seconds else 0.0
+                print(f"  worker {pid}: {stats['rows']} rows in {seconds:.1f}s ({rate:,.0f} rows/s)")
+            total_rows = sum(stats['rows'] for stats in worker_stats.values())
+            print(f"Total rows copied into {'ghcn_daily_wide' if args.output_format == 'wide' else 'ghcn_daily_test'}: {total_rows}")
+        elif args.shards:
+            print(f"\nProcessed data saved to {output_dir}")
+            manifest_path = write_shard_manifest(output_dir, shard_results)
+            write_output_manifest(output_dir, [(r['file'], r['rows'], r['bytes'], r['checksum']) for r in shard_results if r['ok']])
+            stations_written = sum(len(r['stations']) for r in shard_results)
+            print(f"Shards written: {sum(1 for r in shard_results if r['ok'])} of {args.shards}")
+            print(f"Stations written: {stations_written} (manifest: {manifest_path})")
+            print(f"Files remaining: {len(dly_files) - stations_written}")
+        else:
+            save_process_manifest(output_dir, manifest)
+            print(f"\nProcessed data saved to {output_dir}")
+            processed_count = len([f for f in os.listdir(output_dir) if f.endswith(CSV_SUFFIXES)])
+            print(f"Total files processed: {processed_count}")
+            if dly_files is not None:
+                print(f"Files remaining: {len(dly_files) - processed_count}")
+        if dropped_by_element:
+            print_dropped_report(dropped_by_element)
+        if worker_stats:
+            print_worker_report(worker_stats, time.time() - start_time, num_cores)
 
 if __name__ == "__main__":
     main()
@@ -3,82 +3,710 @@
 import psycopg2
 import os
 import csv
+import gzip
+import mmap
+import http.client
 import shutil
 import argparse
+import random
+import re
+import sys
+import zlib
+import socket
+import shlex
 import subprocess
+import threading
+import queue
 import time
 from datetime import timedelta
 import textwrap
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from psycopg2.pool import ThreadedConnectionPool
 from tqdm import tqdm
 
+DSN = "dbname=climate_analysis user=gpadmin host=mdw"
+
+# Identifies this loader in the control table's lease columns; several
+# loaders on different ETL hosts can share one ghcn_load_control_test
+LOADER_ID = f"{socket.gethostname()}:{os.getpid()}"
+DEFAULT_LEASE_SECONDS = 600
+
+# Written next to the processed CSVs by process_ghcn.py: file,rows,bytes,checksum
+OUTPUT_MANIFEST = 'ghcn_output.manifest'
+output_manifests = {}
+manifest_lock = threading.Lock()
+
+GPFDIST_START_TIMEOUT = 30
+GPFDIST_MAX_RESTARTS = 5
+
+# file_name -> size in bytes, as registered in the control table by load_control.py
+registered_sizes = {}
+# file_name -> row count, as read from the processor's sidecar when load_control.py registered the file
+registered_counts = {}
+
+# Each loader thread keeps one pooled session for its whole life
+worker_local = threading.local()
+
 def execute_query(conn, query):
     with conn.cursor() as cur:
         cur.execute(query)
         conn.commit()
 
-def get_next_files(conn, limit):
+def ensure_control_columns(conn):
     with conn.cursor() as cur:
         cur.execute("""
-            SELECT file_name
-            FROM ghcn_load_control_test
-            WHERE status = 'PENDING'
-            ORDER BY file_name
-            LIMIT %s
-            FOR UPDATE SKIP LOCKED
-        """, (limit,))
-        return [row[0] for row in cur.fetchall()]
+            ALTER TABLE ghcn_load_control_test
+                ADD COLUMN IF NOT EXISTS owner VARCHAR(255),
+                ADD COLUMN IF NOT EXISTS lease_expires TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS heartbeat TIMESTAMP,
+                ADD COLUMN IF NOT EXISTS file_size BIGINT,
+                ADD COLUMN IF NOT EXISTS file_mtime BIGINT,
+                ADD COLUMN IF NOT EXISTS expected_row_count INTEGER
+        """)
+    conn.commit()
 
-def update_file_status(conn, file_name, status, csv_record_count=None, inserted_row_count=None, error_condition=None):
+def get_next_files(conn, limit, lease_seconds=DEFAULT_LEASE_SECONDS, order='name'):
+    """
+    Atomically claim up to limit files for this loader: the rows are locked
+    with FOR UPDATE SKIP LOCKED and leased to LOADER_ID in the same
+    statement, then committed, so no other loader (or a later claim in this
+    one) can pick them up once the lock is released.
+
+    Files whose lease has expired (their loader stopped heartbeating) are
+    reclaimed along with PENDING ones. Lease times use the database clock,
+    so ETL hosts don't need synchronised clocks.
+
+    order='size' claims the largest files first (sizes as registered by
+    load_control.py), so the biggest stations aren't left for the last
+    batches. Registered sizes are remembered for assign_files, registered
+    row counts for the rejected-row checks.
+    """
+    order_by = "file_size DESC NULLS LAST, file_name" if order == 'size' else "file_name"
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE ghcn_load_control_test
+            SET status = 'IN_PROGRESS',
+                owner = %s,
+                lease_expires = CURRENT_TIMESTAMP + %s * INTERVAL '1 second',
+                heartbeat = CURRENT_TIMESTAMP,
+                last_updated = CURRENT_TIMESTAMP
+            WHERE file_name IN (
+                SELECT file_name
+                FROM ghcn_load_control_test
+                WHERE status = 'PENDING'
+                   OR (status = 'IN_PROGRESS' AND COALESCE(lease_expires, '-infinity') < CURRENT_TIMESTAMP)
+                ORDER BY {order_by}
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING file_name, file_size, expected_row_count
+        """, (LOADER_ID, lease_seconds, limit))
+        rows = cur.fetchall()
+        registered_sizes.update((file_name, size) for file_name, size, _ in rows if size is not None)
+        registered_counts.update((file_name, count) for file_name, _, count in rows if count is not None)
+        files = sorted(file_name for file_name, _, _ in rows)
+    conn.commit()
+    return files
+
+def renew_leases(conn, lease_seconds):
     with conn.cursor() as cur:
         cur.execute("""
             UPDATE ghcn_load_control_test
-            SET status = %s, csv_record_count = %s, inserted_row_count = %s, error_condition = %s, last_updated = CURRENT_TIMESTAMP
-            WHERE file_name = %s
-        """, (status, csv_record_count, inserted_row_count, error_condition, file_name))
+            SET lease_expires = CURRENT_TIMESTAMP + %s * INTERVAL '1 second',
+                heartbeat = CURRENT_TIMESTAMP
+            WHERE owner = %s AND status = 'IN_PROGRESS'
+        """, (lease_seconds, LOADER_ID))
+        renewed = cur.rowcount
+    conn.commit()
+    return renewed
+
+def lease_heartbeat(lease_seconds, stop_event, debug):
+    """
+    Background thread: renew this loader's leases every third of the lease
+    period on a dedicated session, until stop_event is set.
+    """
+    conn = psycopg2.connect(DSN)
+    try:
+        while not stop_event.wait(lease_seconds / 3):
+            try:
+                renewed = renew_leases(conn, lease_seconds)
+                if debug:
+                    print(f"Heartbeat: renewed {renewed} leases for {LOADER_ID}")
+            except Exception as e:
+                print(f"Error renewing leases: {str(e)}")
+                conn.rollback()
+    finally:
+        conn.close()
+
+class LeaseLostError(RuntimeError):
+    """Another loader reclaimed some of the files being loaded; the load must be rolled back."""
+
+def assert_leases_held(conn, file_names):
+    """
+    Lock this loader's claims on file_names in the current transaction and
+    raise LeaseLostError unless it still holds every one of them. Run it
+    right before the commit that makes a load visible: the row locks keep
+    anyone from reclaiming the files until that commit.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE ghcn_load_control_test
+            SET heartbeat = CURRENT_TIMESTAMP
+            WHERE file_name = ANY(%s::text[]) AND owner = %s AND status = 'IN_PROGRESS'
+            RETURNING file_name
+        """, (list(file_names), LOADER_ID))
+        held = {row[0] for row in cur.fetchall()}
+    lost = sorted(set(file_names) - held)
+    if lost:
+        raise LeaseLostError(f"Lease lost on {len(lost)} of {len(set(file_names))} files (e.g. {lost[0]}); another loader reclaimed them")
+
+def requeue_files(conn, file_names):
+    """After a lost lease: put the files this loader still holds back to PENDING so they are loaded again."""
+    update_file_statuses(conn, file_names, 'PENDING', error_conditions=['Requeued: lease lost during a shared load'] * len(file_names))
+
+def update_file_statuses(conn, file_names, status, csv_record_counts=None, inserted_row_counts=None, error_conditions=None):
+    """
+    Set the status of many files in one statement and one commit. The
+    optional per-file lists line up with file_names. Only files this loader
+    still holds (or that were never leased) are updated, so a loader whose
+    lease was reclaimed can't overwrite the new owner's result. Returns the
+    number of files updated.
+    """
+    if not file_names:
+        return 0
+    count = len(file_names)
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE ghcn_load_control_test c
+            SET status = %s,
+                csv_record_count = u.csv_record_count,
+                inserted_row_count = u.inserted_row_count,
+                error_condition = u.error_condition,
+                lease_expires = NULL,
+                last_updated = CURRENT_TIMESTAMP
+            FROM unnest(%s::text[], %s::int[], %s::int[], %s::text[])
+                AS u(file_name, csv_record_count, inserted_row_count, error_condition)
+            WHERE c.file_name = u.file_name
+              AND (c.owner IS NULL OR c.owner = %s)
+        """, (status, list(file_names),
+              list(csv_record_counts or [None] * count),
+              list(inserted_row_counts or [None] * count),
+              list(error_conditions or [None] * count),
+              LOADER_ID))
+        updated = cur.rowcount
         conn.commit()
+    if updated < count:
+        print(f"{count - updated} of {count} files are held by another loader now; left their status alone")
+    return updated
 
-def count_csv_records(file_path):
-    with open(file_path, 'r') as file:
-        return sum(1 for _ in csv.reader(file)) - 1  # Subtract 1 for header
-
-def create_gpfdist_directories(base_dir, num_servers):
-    dirs = []
-    for i in range(num_servers):
-        dir_path = os.path.join(base_dir, f'gpfdist_{i}')
-        os.makedirs(dir_path, exist_ok=True)
-        dirs.append(dir_path)
-    return dirs
-
-def distribute_files(file_list, gpfdist_dirs):
-    for i, file_path in enumerate(file_list):
-        target_dir = gpfdist_dirs[i % len(gpfdist_dirs)]
-        symlink_path = os.path.join(target_dir, os.path.basename(file_path))
-        os.symlink(file_path, symlink_path)
-
-def start_gpfdist(data_dir, port, verbose):
-    log_file = 'gpfdist.log' if not verbose else None
-    if log_file:
-        log = open(log_file, 'a')
+def update_file_status(conn, file_name, status, csv_record_count=None, inserted_row_count=None, error_condition=None):
+    update_file_statuses(conn, [file_name], status, [csv_record_count], [inserted_row_count], [error_condition])
+
+def open_csv(file_path):
+    """Open a processed CSV as a binary stream, decompressing .csv.gz/.csv.zst."""
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'rb')
+    if file_path.endswith('.zst'):
+        import zstandard  # optional dependency, only needed for .csv.zst files
+        return zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+    return open(file_path, 'rb')
+
+def count_lines(file_path, chunk_size=16 * 1024 * 1024):
+    """
+    Count lines by counting newline bytes: through an mmap for plain CSVs,
+    chunk by chunk for compressed ones. A final line without a newline
+    still counts.
+    """
+    lines = 0
+    last = b"\n"
+    if file_path.endswith(('.gz', '.zst')):
+        with open_csv(file_path) as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                lines += chunk.count(b"\n")
+                last = chunk[-1:]
     else:
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for offset in range(0, len(mm), chunk_size):
+                    lines += mm[offset:offset + chunk_size].count(b"\n")
+                last = mm[-1:]
+    return lines + (0 if last == b"\n" else 1)
+
+def load_output_manifest(directory):
+    """
+    The processor's sidecar for directory, as {file: (rows, bytes, checksum)};
+    empty if there is none. Cached until the sidecar is rewritten.
+    """
+    path = os.path.join(directory, OUTPUT_MANIFEST)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with manifest_lock:
+        cached = output_manifests.get(directory)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        with open(path, newline='') as f:
+            entries = {row['file']: (int(row['rows']), int(row['bytes']), row['checksum']) for row in csv.DictReader(f)}
+        output_manifests[directory] = (mtime, entries)
+        return entries
+
+def manifest_record_count(file_path):
+    """
+    Row count registered with the file, else from the sidecar; None if
+    neither has one matching the file's current size.
+    """
+    if file_path in registered_counts:
+        return registered_counts[file_path]
+    entry = load_output_manifest(os.path.dirname(file_path)).get(os.path.basename(file_path))
+    if entry is None or entry[1] != file_size(file_path):
+        return None
+    return entry[0]
+
+def count_csv_records(file_path):
+    rows = manifest_record_count(file_path)
+    if rows is not None:
+        return rows
+    return max(count_lines(file_path) - 1, 0)  # Subtract 1 for header
+
+def batch_record_counts(file_names):
+    """Registered or sidecar row counts for a batch, or None unless every file has one (batches are never rescanned)."""
+    counts = [manifest_record_count(file_name) for file_name in file_names]
+    return None if None in counts else counts
+
+def batch_error(counts, inserted, rejected):
+    if counts is None:
+        return None
+    if inserted + rejected != sum(counts):
+        return f"Batch rows inserted: {inserted}, rejected: {rejected} (expected {sum(counts)})"
+    if rejected:
+        return f"Batch rows rejected: {rejected}"
+    return None
+
+def station_id_for(file_path):
+    # USC00012345.csv, .csv.gz and .csv.zst all belong to station USC00012345
+    return os.path.basename(file_path).split('.')[0]
+
+def parse_gpfdist_hosts(spec, default_data_root):
+    """
+    Parse --gpfdist-hosts: a comma-separated list of host[:data_root]. A
+    host's data_root is the directory of processed CSVs stored on that host;
+    hosts without one serve default_data_root (shared storage).
+    """
+    hosts = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, data_root = entry.partition(':')
+        hosts.append((host, os.path.normpath(data_root or default_data_root)))
+    return hosts
+
+def is_local_host(host):
+    return host in ('localhost', '127.0.0.1', socket.gethostname(), socket.gethostname().split('.')[0])
+
+def run_remote(host, script, input_text=None):
+    return subprocess.run(['ssh', host, script], input=input_text, text=True, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+def plan_gpfdist_fleet(hosts, per_host, first_port, work_dir, batch):
+    """
+    One gpfdist instance per (host, port). In batch mode each instance
+    serves its own work directory of symlinks on its host; otherwise it
+    serves the host's data_root directly.
+    """
+    instances = []
+    for host, data_root in hosts:
+        for i in range(per_host):
+            port = first_port + i
+            instances.append({
+                'host': host,
+                'port': port,
+                'data_root': data_root,
+                'dir': os.path.join(work_dir, f'gpfdist_{host}_{port}') if batch else data_root,
+                'process': None,
+            })
+    return instances
+
+def create_gpfdist_directories(instances, subdirs=('',)):
+    for instance in instances:
+        dir_paths = [os.path.join(instance['dir'], subdir) for subdir in subdirs]
+        if is_local_host(instance['host']):
+            for dir_path in dir_paths:
+                os.makedirs(dir_path, exist_ok=True)
+        else:
+            run_remote(instance['host'], 'mkdir -p ' + ' '.join(shlex.quote(d) for d in dir_paths))
+
+def remove_gpfdist_directories(instances):
+    for instance in instances:
+        if is_local_host(instance['host']):
+            shutil.rmtree(instance['dir'], ignore_errors=True)
+        else:
+            try:
+                run_remote(instance['host'], f"rm -rf {shlex.quote(instance['dir'])}")
+            except subprocess.CalledProcessError as e:
+                print(f"Error removing {instance['dir']} on {instance['host']}: {e.stderr.strip()}")
+
+def serves_file(instance, file_path):
+    return os.path.commonpath([instance['data_root'], file_path]) == instance['data_root']
+
+def throughput_weights(instances, weighted):
+    """
+    Relative speed of each instance, from the bytes per second it sustained
+    on the per-file loads it served alone, timed over the INSERT that reads
+    the external table (batch loads can't be attributed to one instance,
+    so --weighted is per-file only). Unmeasured instances count as average.
+    """
+    if not weighted:
+        return {id(instance): 1.0 for instance in instances}
+    rates = {id(instance): instance['stats']['timed_bytes'] / instance['stats']['timed_seconds']
+             for instance in instances if instance['stats']['timed_seconds'] > 0}
+    if not rates:
+        return {id(instance): 1.0 for instance in instances}
+    mean_rate = sum(rates.values()) / len(rates)
+    return {id(instance): rates.get(id(instance), mean_rate) / mean_rate for instance in instances}
+
+def assign_files(file_list, instances, weighted=False):
+    """
+    Greedy bin-packing of files onto gpfdist instances: largest file first,
+    each to the instance on a host that stores it (by data_root) that would
+    finish soonest, i.e. the lowest (assigned bytes + file size) / weight.
+    Returns ([(instance, files, bytes), ...] for every instance, weights,
+    files no instance can serve).
+    """
+    weights = throughput_weights(instances, weighted)
+    loads = {id(instance): 0 for instance in instances}
+    assigned = {id(instance): [] for instance in instances}
+    unservable = []
+    sizes = {file_path: file_size(file_path) for file_path in file_list}
+    for file_path in sorted(file_list, key=lambda file_path: sizes[file_path], reverse=True):
+        eligible = [instance for instance in instances if serves_file(instance, file_path)]
+        if not eligible:
+            unservable.append(file_path)
+            continue
+        # File count breaks ties, e.g. remote-only files with unknown size
+        target = min(eligible, key=lambda instance: ((loads[id(instance)] + sizes[file_path]) / weights[id(instance)],
+                                                     len(assigned[id(instance)])))
+        loads[id(target)] += sizes[file_path]
+        assigned[id(target)].append(file_path)
+    return [(instance, assigned[id(instance)], loads[id(instance)]) for instance in instances], weights, unservable
+
+def balance_summary(assignment, weights):
+    """One line on how evenly a batch is spread: max over mean of the expected finish times."""
+    finish = [load / weights[id(instance)] for instance, _, load in assignment]
+    mean_finish = sum(finish) / len(finish) if finish else 0.0
+    imbalance = max(finish) / mean_finish if mean_finish else 1.0
+    loads_mb = [load / (1024 * 1024) for _, _, load in assignment]
+    return (f"{sum(1 for _, files, _ in assignment if files)}/{len(assignment)} instances, "
+            f"{min(loads_mb):,.1f}-{max(loads_mb):,.1f} MB each, imbalance {imbalance:.2f}")
+
+def distribute_files(assignment, subdir=''):
+    """
+    Symlink each instance's assigned files into its work directory. Returns
+    the instances that were given files, which are the only ones the batch's
+    LOCATION clause should list.
+    """
+    loaded = []
+    remote_links = {}
+    for instance, files, load in assignment:
+        if not files:
+            continue
+        loaded.append(instance)
+        record_gpfdist_traffic(instance, files=len(files), bytes_served=load)
+        target_dir = os.path.join(instance['dir'], subdir)
+        links = [(file_path, os.path.join(target_dir, os.path.basename(file_path))) for file_path in files]
+        if is_local_host(instance['host']):
+            for file_path, symlink_path in links:
+                os.symlink(file_path, symlink_path)
+        else:
+            remote_links.setdefault(instance['host'], []).extend(links)
+
+    # One ssh round trip per remote host, with the link list on stdin
+    for host, links in remote_links.items():
+        run_remote(host, 'while IFS= read -r src && IFS= read -r dst; do ln -s "$src" "$dst" || exit 1; done',
+                   "".join(f"{src}\n{dst}\n" for src, dst in links))
+    return loaded
+
+def fail_unservable(conn, files):
+    if files:
+        print(f"{len(files)} files are not under any gpfdist host's data_root")
+        update_file_statuses(conn, files, 'FAILED', error_conditions=['No gpfdist host serves this file'] * len(files))
+
+def interleave_by_host(instances):
+    """Order instances host by host in turn, so any prefix spreads across hosts."""
+    by_host = {}
+    for instance in instances:
+        by_host.setdefault(instance['host'], []).append(instance)
+    interleaved = []
+    while any(by_host.values()):
+        for host_instances in by_host.values():
+            if host_instances:
+                interleaved.append(host_instances.pop(0))
+    return interleaved
+
+class BatchController:
+    """
+    Batch-mode feedback controller: hill-climbs batch size and active gpfdist
+    streams, one knob at a time, on observed rows/s. Every decision is printed.
+    """
+
+    def __init__(self, batch_size, streams, min_batch_size, max_batch_size, min_streams, max_streams,
+                 max_batch_seconds, adaptive=True, tolerance=0.05, growth=1.5):
+        self.settings = {'batch_size': batch_size, 'streams': streams}
+        self.limits = {'batch_size': (min_batch_size, max_batch_size), 'streams': (min_streams, max_streams)}
+        self.max_batch_seconds = max_batch_seconds
+        self.adaptive = adaptive
+        self.tolerance = tolerance
+        self.growth = growth
+        self.knob = 'batch_size'
+        self.directions = {'batch_size': 1, 'streams': 1}
+        self.base_rate = None
+        self.batches = 0
+
+    @property
+    def batch_size(self):
+        return self.settings['batch_size']
+
+    @property
+    def streams(self):
+        return self.settings['streams']
+
+    def active_instances(self, instances, streams=None):
+        return instances[:streams or self.streams]
+
+    def step(self, knob, direction):
+        """Move knob one step in direction; False if it is already at its limit."""
+        value = self.settings[knob]
+        if knob == 'batch_size':
+            value = int(value * self.growth) if direction > 0 else int(value / self.growth)
+        else:
+            value += direction
+        low, high = self.limits[knob]
+        value = min(high, max(low, value))
+        moved = value != self.settings[knob]
+        self.settings[knob] = value
+        return moved
+
+    def other_knob(self):
+        self.knob = 'streams' if self.knob == 'batch_size' else 'batch_size'
+        return self.knob
+
+    def observe(self, files, rows, seconds, settings=None):
+        self.batches += 1
+        if not self.adaptive:
+            return
+        rate = rows / seconds if seconds else 0.0
+        before = dict(self.settings)
+
+        # Pipelined batches are staged before the previous one is observed
+        if settings is not None and settings != self.settings:
+            reason = (f"staged with batch size {settings['batch_size']}, streams {settings['streams']} "
+                      f"before the last change, not used for tuning")
+        elif seconds > self.max_batch_seconds:
+            self.settings['batch_size'] = max(self.limits['batch_size'][0], before['batch_size'] // 2)
+            self.base_rate = None
+            reason = f"batch took longer than {self.max_batch_seconds}s"
+        elif files < self.batch_size:
+            reason = "partial batch, not used for tuning"
+        elif self.base_rate is None:
+            self.base_rate = rate
+            reason = f"baseline, probing {self.knob}"
+            if not self.step(self.knob, self.directions[self.knob]):
+                self.directions[self.knob] = -self.directions[self.knob]
+        elif rate >= self.base_rate * (1 + self.tolerance):
+            reason = f"rows/s up {rate / self.base_rate - 1:.0%}, stepping {self.knob} again"
+            self.base_rate = rate
+            if not self.step(self.knob, self.directions[self.knob]):
+                knob = self.other_knob()
+                reason += f"; at limit, probing {knob}"
+                self.step(knob, self.directions[knob])
+        elif rate <= self.base_rate * (1 - self.tolerance):
+            knob = self.knob
+            self.step(knob, -self.directions[knob])
+            self.directions[knob] = -self.directions[knob]
+            reason = f"rows/s down {1 - rate / self.base_rate:.0%}, undoing {knob} step"
+            # Re-measure at the restored settings before the next probe, which tries the other knob
+            self.base_rate = None
+            self.other_knob()
+        else:
+            self.base_rate = rate
+            knob = self.other_knob()
+            reason = f"rows/s unchanged, probing {knob}"
+            if not self.step(knob, self.directions[knob]):
+                self.directions[knob] = -self.directions[knob]
+
+        print(f"Controller: batch {self.batches}: {files} files, {rows} rows in {seconds:.1f}s ({rate:,.0f} rows/s); "
+              f"batch size {before['batch_size']} -> {self.batch_size}, streams {before['streams']} -> {self.streams} ({reason})")
+
+def clear_directories(instances, subdir=''):
+    for instance in instances:
+        dir_path = os.path.join(instance['dir'], subdir)
+        if is_local_host(instance['host']):
+            for file_name in os.listdir(dir_path):
+                file_path = os.path.join(dir_path, file_name)
+                if os.path.islink(file_path):
+                    os.unlink(file_path)
+        else:
+            run_remote(instance['host'], f"find {shlex.quote(dir_path)} -maxdepth 1 -type l -delete")
+
+def gpfdist_location(instance, path):
+    return f"'gpfdist://{instance['host']}:{instance['port']}/{path}'"
+
+def probe_gpfdist(host, port, timeout=1.0):
+    """True once something answers HTTP on host:port; any status will do."""
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('GET', '/')
+        conn.getresponse()
+        return True
+    except (OSError, http.client.HTTPException):
+        return False
+    finally:
+        conn.close()
+
+def wait_for_gpfdist(instance, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if instance['process'].poll() is not None:
+            return False
+        if probe_gpfdist(instance['host'], instance['port']):
+            return True
+        time.sleep(0.2)
+    return False
+
+def start_gpfdist(instance, verbose):
+    """
+    Launch one gpfdist instance, locally or over ssh on its ETL host, without
+    waiting for it. Output goes to a per-instance log whose handle is kept on
+    the instance and closed by stop_gpfdist.
+    """
+    if verbose:
+        instance['log'] = None
         log = subprocess.DEVNULL
+    else:
+        instance['log'] = log = open(f"gpfdist_{instance['host']}_{instance['port']}.log", 'a')
+
+    command = ['gpfdist', '-d', instance['dir'], '-p', str(instance['port'])]
+    if not is_local_host(instance['host']):
+        command = ['ssh', instance['host'], 'exec ' + ' '.join(shlex.quote(arg) for arg in command)]
 
     try:
-        process = subprocess.Popen(
-            ['gpfdist', '-d', data_dir, '-p', str(port)],
+        instance['process'] = subprocess.Popen(
+            command,
             stdout=log,
             stderr=subprocess.STDOUT
         )
-        time.sleep(2)  # Give gpfdist some time to start
-        return process
+        return instance['process']
     except Exception as e:
-        print(f"Error starting gpfdist on port {port}: {str(e)}")
-        if log_file:
-            log.close()
+        print(f"Error starting gpfdist on {instance['host']}:{instance['port']}: {str(e)}")
+        close_gpfdist_log(instance)
         return None
 
-def stop_gpfdist(processes):
-    for process in processes:
+def close_gpfdist_log(instance):
+    if instance.get('log'):
+        instance['log'].close()
+        instance['log'] = None
+
+def start_gpfdist_fleet(instances, verbose, timeout=GPFDIST_START_TIMEOUT):
+    """
+    Start every instance at once, then probe their HTTP ports in parallel.
+    Returns the instances that came up; the rest are stopped.
+    """
+    for instance in instances:
+        instance.setdefault('lock', threading.Lock())
+        instance.setdefault('restarts', 0)
+        instance.setdefault('stats', {'files': 0, 'bytes': 0, 'requests': 0, 'timed_bytes': 0, 'timed_seconds': 0.0})
+        start_gpfdist(instance, verbose)
+
+    launched = [instance for instance in instances if instance['process']]
+    with ThreadPoolExecutor(max_workers=max(len(launched), 1)) as executor:
+        ready = list(executor.map(lambda instance: wait_for_gpfdist(instance, timeout), launched))
+
+    started = []
+    for instance, is_ready in zip(launched, ready):
+        if is_ready:
+            started.append(instance)
+        else:
+            print(f"gpfdist on {instance['host']}:{instance['port']} did not become ready within {timeout}s")
+            stop_gpfdist([instance])
+    return started
+
+def restart_gpfdist(instance, verbose, timeout=GPFDIST_START_TIMEOUT):
+    """
+    Restart the instance if its process has exited. Returns False once it has
+    used up GPFDIST_MAX_RESTARTS or won't come back up.
+    """
+    with instance['lock']:
+        process = instance['process']
+        if process and process.poll() is None:
+            return True
+        if instance['restarts'] >= GPFDIST_MAX_RESTARTS:
+            return False
+        status = process.returncode if process else None
+        print(f"gpfdist on {instance['host']}:{instance['port']} exited (status {status}); restarting")
+        close_gpfdist_log(instance)
+        instance['restarts'] += 1
+        if start_gpfdist(instance, verbose) and wait_for_gpfdist(instance, timeout):
+            return True
+        print(f"Restart of gpfdist on {instance['host']}:{instance['port']} failed")
+        stop_gpfdist([instance])
+        return False
+
+def check_gpfdist(instances, verbose):
+    """Make sure every instance is serving before a load; raise if one can't be restarted."""
+    dead = [f"{instance['host']}:{instance['port']}" for instance in instances if not restart_gpfdist(instance, verbose)]
+    if dead:
+        raise RuntimeError(f"gpfdist instance(s) down: {', '.join(dead)}")
+
+def supervise_gpfdist(instances, verbose, stop_event, interval=1.0):
+    """Background thread: restart crashed instances between checks, until stop_event is set."""
+    while not stop_event.wait(interval):
+        for instance in instances:
+            if stop_event.is_set():
+                break
+            restart_gpfdist(instance, verbose)
+
+def record_gpfdist_traffic(instance, requests=0, files=0, bytes_served=0):
+    """
+    Loader-side accounting of what each instance served: one request per
+    external table scan that lists it, plus the files and bytes it was given.
+    gpfdist itself doesn't report these.
+    """
+    with instance['lock']:
+        stats = instance['stats']
+        stats['requests'] += requests
+        stats['files'] += files
+        stats['bytes'] += bytes_served
+
+def record_gpfdist_throughput(instance, bytes_served, seconds):
+    with instance['lock']:
+        instance['stats']['timed_bytes'] += bytes_served
+        instance['stats']['timed_seconds'] += seconds
+
+def file_size(file_path):
+    if file_path in registered_sizes:
+        return registered_sizes[file_path]
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return 0  # stored only on a remote ETL host and registered without a size
+
+def print_gpfdist_stats(instances, elapsed_time):
+    print("\nPer-gpfdist traffic:")
+    for instance in instances:
+        stats = instance['stats']
+        mb = stats['bytes'] / (1024 * 1024)
+        rate = mb / elapsed_time if elapsed_time else 0.0
+        print(f"  {instance['host']}:{instance['port']}: {stats['requests']} requests, {stats['files']} files, "
+              f"{mb:,.1f} MB ({rate:,.1f} MB/s), {instance['restarts']} restarts")
+
+def stop_gpfdist(instances):
+    for instance in instances:
+        process = instance['process']
+        if not process:
+            continue
         try:
             process.terminate()
             process.wait(timeout=5)
@@ -86,8 +714,26 @@ def stop_gpfdist(processes):
             process.kill()
         except Exception as e:
             print(f"Error stopping gpfdist process: {str(e)}")
+        if not is_local_host(instance['host']):
+            # Closing the ssh session doesn't reliably stop the remote gpfdist
+            subprocess.run(['ssh', instance['host'], f"pkill -f {shlex.quote('[g]pfdist -d ' + instance['dir'] + ' -p ' + str(instance['port']))}"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        instance['process'] = None
+        close_gpfdist_log(instance)
 
-def process_file(file_name, conn, gpfdist_ports, verbose, display_definition, debug):
+def rejected_row_count(conn, ext_table_name):
+    """Rows the external table rejected on the last scan, from its LOG ERRORS log."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM gp_read_error_log(%s)", (ext_table_name,))
+        return cur.fetchone()[0]
+
+def deep_verify_count(conn, station_id):
+    # Full per-station COUNT(*): scans every partition, so it is only run for a sample of files
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM ghcn_daily_test WHERE station_id = %s", (station_id,))
+        return cur.fetchone()[0]
+
+def process_file(file_name, conn, instance, verbose, display_definition, debug, verify_sample=0.0):
     try:
         if debug:
             print(f"Started processing file: {file_name}")
@@ -96,8 +742,11 @@ def process_file(file_name, conn, gpfdist_ports, verbose, display_definition, de
         if verbose:
             print(f"Number of records in the file (excluding header): {csv_record_count}")
 
-        table_name = f"temp_ext_{os.path.splitext(os.path.basename(file_name))[0]}"
-        gpfdist_locations = ", ".join([f"'gpfdist://mdw:{port}/{os.path.basename(file_name)}'" for port in gpfdist_ports])
+        table_name = f"temp_ext_{station_id_for(file_name)}"
+        # One instance per file; listing several would make each of them
+        # serve the whole file
+        gpfdist_locations = gpfdist_location(instance, os.path.relpath(file_name, instance['data_root']))
+        record_gpfdist_traffic(instance, requests=1, files=1, bytes_served=file_size(file_name))
 
         external_table_definition = f"""
         CREATE EXTERNAL TABLE {table_name} (
@@ -111,7 +760,7 @@ def process_file(file_name, conn, gpfdist_ports, verbose, display_definition, de
         )
         LOCATION ({gpfdist_locations})
         FORMAT 'CSV' (HEADER)
-        SEGMENT REJECT LIMIT 1 PERCENT;
+        LOG ERRORS SEGMENT REJECT LIMIT 1 PERCENT;
         """
 
         with conn.cursor() as cur:
@@ -121,22 +770,38 @@ def process_file(file_name, conn, gpfdist_ports, verbose, display_definition, de
             print("\nExternal Table Definition:")
             print(textwrap.dedent(external_table_definition).strip())
 
+        # Verify from what the load itself reports (INSERT rowcount plus the
+        # reject log) rather than re-counting the station in a 3B-row table
+        insert_started = time.time()
         with conn.cursor() as cur:
             cur.execute(f"""
                 INSERT INTO ghcn_daily_test
-                SELECT DISTINCT * FROM {table_name};
+                SELECT * FROM {table_name};
             """)
-        conn.commit()
-
-        with conn.cursor() as cur:
-            cur.execute(f"SELECT COUNT(*) FROM ghcn_daily_test WHERE station_id = %s", (os.path.splitext(os.path.basename(file_name))[0],))
-            inserted_row_count = cur.fetchone()[0]
+            inserted_row_count = cur.rowcount
+        insert_seconds = time.time() - insert_started
+        rejected_count = rejected_row_count(conn, table_name)
 
         error_condition = None
-        if inserted_row_count != csv_record_count:
-            error_condition = f"Rows inserted: {inserted_row_count} (expected {csv_record_count})"
+        if inserted_row_count + rejected_count != csv_record_count:
+            error_condition = f"Rows inserted: {inserted_row_count}, rejected: {rejected_count} (expected {csv_record_count})"
+        elif rejected_count:
+            error_condition = f"Rows rejected: {rejected_count}"
 
+        if verify_sample and random.random() < verify_sample:
+            station_id = station_id_for(file_name)
+            table_count = deep_verify_count(conn, station_id)
+            if debug:
+                print(f"Deep check for {station_id}: {table_count} rows in ghcn_daily_test")
+            if table_count != inserted_row_count:
+                error_condition = f"Deep check: {table_count} rows in table for {station_id} (inserted {inserted_row_count})"
+
+        # The rows and the COMPLETED status commit together, and only while
+        # this loader still holds the file
+        assert_leases_held(conn, [file_name])
         update_file_status(conn, file_name, 'COMPLETED', csv_record_count, inserted_row_count, error_condition)
+        # Only the INSERT reads from gpfdist; DDL and bookkeeping aren't its throughput
+        record_gpfdist_throughput(instance, file_size(file_name), insert_seconds)
         if verbose:
             print(f"Processed {inserted_row_count} rows for file: {file_name}")
 
@@ -146,15 +811,54 @@ def process_file(file_name, conn, gpfdist_ports, verbose, display_definition, de
 
         if debug:
             print(f"Finished processing file: {file_name}")
+        return inserted_row_count
 
     except Exception as e:
         print(f"Error processing file {file_name}: {str(e)}")
         conn.rollback()
+        if isinstance(e, LeaseLostError):
+            return 0
         update_file_status(conn, file_name, 'FAILED', error_condition=str(e))
+        return 0
+
+def get_worker_conn(pool):
+    if not hasattr(worker_local, 'conn'):
+        worker_local.conn = pool.getconn()
+    return worker_local.conn
+
+def process_file_pooled(file_name, pool, conn_stats, stats_lock, instance, verbose, display_definition, debug, verify_sample):
+    """
+    Run process_file on this thread's own session and record per-connection
+    throughput and latency.
+    """
+    conn = get_worker_conn(pool)
+    started = time.time()
+    rows = process_file(file_name, conn, instance, verbose, display_definition, debug, verify_sample)
+    latency = time.time() - started
+    with stats_lock:
+        stats = conn_stats.setdefault(conn.get_backend_pid(), {'files': 0, 'rows': 0, 'seconds': 0.0, 'max_latency': 0.0})
+        stats['files'] += 1
+        stats['rows'] += rows
+        stats['seconds'] += latency
+        stats['max_latency'] = max(stats['max_latency'], latency)
 
-def batch_process(conn, gpfdist_dirs, gpfdist_ports, batch_size, verbose, display_definition, debug):
-    ext_table_name = "ext_ghcn_batch"
-    gpfdist_locations = [f"'gpfdist://mdw:{port}/*.csv'" for port in gpfdist_ports]
+def print_connection_stats(conn_stats):
+    print("\nPer-connection throughput:")
+    for backend_pid, stats in sorted(conn_stats.items()):
+        rows_per_s = stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0
+        avg_latency = stats['seconds'] / stats['files'] if stats['files'] else 0.0
+        print(f"  session {backend_pid}: {stats['files']} files, {stats['rows']} rows, {rows_per_s:,.0f} rows/s, "
+              f"avg {avg_latency:.2f}s/file, max {stats['max_latency']:.2f}s")
+
+def batch_process(conn, instances, batch_size, verbose, display_definition, debug, slot=None, target_table='ghcn_daily_test'):
+    # Named per loader: loaders sharing one name would queue on its catalog entry until each commits
+    ext_table_name = f"ext_ghcn_batch_{loader_tag()}"
+    # In pipelined mode each gpfdist directory has one subdirectory per staging slot.
+    # *.csv* also matches .csv.gz and .csv.zst, which gpfdist decompresses as it serves them
+    prefix = f"slot{slot}/" if slot is not None else ""
+    gpfdist_locations = [gpfdist_location(instance, f"{prefix}*.csv*") for instance in instances]
+    for instance in instances:
+        record_gpfdist_traffic(instance, requests=1)
     location_clause = ", ".join(gpfdist_locations)
 
     create_ext_table_sql = f"""
@@ -169,7 +873,7 @@ def batch_process(conn, gpfdist_dirs, gpfdist_ports, batch_size, verbose, displa
     )
     LOCATION ({location_clause})
     FORMAT 'CSV' (HEADER)
-    SEGMENT REJECT LIMIT 1 PERCENT;
+    LOG ERRORS SEGMENT REJECT LIMIT 1 PERCENT;
     """
 
     if display_definition:
@@ -185,10 +889,13 @@ def batch_process(conn, gpfdist_dirs, gpfdist_ports, batch_size, verbose, displa
 
     try:
         with conn.cursor() as cur:
-            cur.execute(f"INSERT INTO ghcn_daily_test SELECT * FROM {ext_table_name}")
+            cur.execute(f"INSERT INTO {target_table} SELECT * FROM {ext_table_name}")
+            inserted_row_count = cur.rowcount
+        rejected_count = rejected_row_count(conn, ext_table_name)
 
         if verbose:
-            print(f"Inserted data from external table into ghcn_daily_test")
+            print(f"Inserted {inserted_row_count} rows from external table into {target_table} ({rejected_count} rejected)")
+        return inserted_row_count, rejected_count
 
     finally:
         with conn.cursor() as cur:
@@ -197,49 +904,311 @@ def batch_process(conn, gpfdist_dirs, gpfdist_ports, batch_size, verbose, displa
         if debug:
             print(f"Dropped external table: {ext_table_name}")
 
+def partition_leaves(conn, table_name='ghcn_daily_test'):
+    """
+    Leaf partitions of table_name as dicts with name, start and end dates
+    (None for the default partition), access method and reloptions.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.oid::regclass::text, pg_get_expr(c.relpartbound, c.oid), am.amname, c.reloptions
+            FROM pg_partition_tree(%s::regclass) t
+            JOIN pg_class c ON c.oid = t.relid
+            LEFT JOIN pg_am am ON am.oid = c.relam
+            WHERE t.isleaf
+        """, (table_name,))
+        leaves = []
+        for name, bound, access_method, reloptions in cur.fetchall():
+            match = re.search(r"FROM \('([^']+)'\) TO \('([^']+)'\)", bound or '')
+            leaves.append({'name': name, 'start': match.group(1) if match else None, 'end': match.group(2) if match else None,
+                           'access_method': access_method, 'reloptions': reloptions or []})
+    return sorted(leaves, key=lambda leaf: leaf['start'] or '')
+
+def loader_tag():
+    """LOADER_ID as an identifier fragment: host names and pids repeat across ETL hosts, the pair doesn't."""
+    tag = re.sub(r'[^a-z0-9]+', '_', LOADER_ID.lower()).strip('_')
+    if len(tag) > 40:
+        tag = f"{tag[:31]}_{zlib.crc32(LOADER_ID.encode()):08x}"
+    return tag
+
+class PartitionExchanger:
+    """
+    Exchange load mode: batches land in per-leaf stage tables, committed with
+    their files' statuses by exchange(). Empty leaves are swapped in with
+    EXCHANGE PARTITION, the others get the stage rows inserted into the leaf.
+    """
+
+    landing = 'ghcn_exchange_landing'
+
+    def __init__(self, conn, debug):
+        self.conn = conn
+        self.debug = debug
+        self.leaves = partition_leaves(conn)
+        self.default = next((leaf for leaf in self.leaves if not leaf['start']), None)
+        self.stages = {}
+        self.pending = []
+        if not any(leaf['start'] for leaf in self.leaves):
+            raise RuntimeError("--exchange needs ghcn_daily_test range-partitioned on observation_date")
+        bounds = [f"PARTITION p{i} START ('{leaf['start']}') END ('{leaf['end']}')"
+                  for i, leaf in enumerate(self.leaves) if leaf['start']]
+        if self.default:
+            bounds.append("DEFAULT PARTITION other")
+        with conn.cursor() as cur:
+            cur.execute(f"""
+                CREATE TEMP TABLE {self.landing} (LIKE ghcn_daily_test)
+                DISTRIBUTED BY (station_id)
+                PARTITION BY RANGE (observation_date) ({', '.join(bounds)})
+            """)
+        conn.commit()
+        # Landing leaf name -> the ghcn_daily_test leaf with the same bounds
+        targets = {leaf['start']: leaf for leaf in self.leaves}
+        self.landing_targets = {leaf['name']: targets[leaf['start']] for leaf in partition_leaves(conn, self.landing)}
+
+    def stage_table(self, leaf):
+        if leaf['name'] not in self.stages:
+            stage = f"ghcn_stage_{loader_tag()}_{leaf['start'][:4] if leaf['start'] else 'default'}"
+            using = f" USING {leaf['access_method']}" if leaf['access_method'] else ""
+            with_options = f" WITH ({', '.join(leaf['reloptions'])})" if leaf['reloptions'] else ""
+            with self.conn.cursor() as cur:
+                cur.execute(f"DROP TABLE IF EXISTS {stage}")
+                cur.execute(f"CREATE TABLE {stage} (LIKE ghcn_daily_test){using}{with_options} DISTRIBUTED BY (station_id)")
+            self.stages[leaf['name']] = stage
+            if self.debug:
+                print(f"Created stage table {stage} for {leaf['name']}")
+        return self.stages[leaf['name']]
+
+    def stage_batch(self, files, csv_record_counts, error_condition):
+        """Move the landed batch into stage tables and queue its files for the next exchange."""
+        with self.conn.cursor() as cur:
+            # One pass finds the landing leaves that got rows; each is then read once
+            cur.execute(f"SELECT DISTINCT tableoid::regclass::text FROM {self.landing}")
+            for (landing_leaf,) in cur.fetchall():
+                cur.execute(f"INSERT INTO {self.stage_table(self.landing_targets[landing_leaf])} SELECT * FROM {landing_leaf}")
+            cur.execute(f"TRUNCATE {self.landing}")
+        self.conn.commit()
+        self.pending.append((files, csv_record_counts or [None] * len(files), error_condition))
+
+    def discard(self):
+        """Drop the stage tables and forget the pending batches, e.g. after a lost lease."""
+        with self.conn.cursor() as cur:
+            for stage in self.stages.values():
+                cur.execute(f"DROP TABLE IF EXISTS {stage}")
+        self.conn.commit()
+        self.stages = {}
+        self.pending = []
+
+    def exchange(self):
+        if not self.pending:
+            return
+        started = time.time()
+        files = [file_name for batch_files, _, _ in self.pending for file_name in batch_files]
+        try:
+            # Locks the claims until the exchange commits
+            assert_leases_held(self.conn, files)
+        except LeaseLostError as e:
+            print(f"Discarding {len(self.stages)} staged partitions: {str(e)}")
+            self.conn.rollback()
+            self.discard()
+            requeue_files(self.conn, files)
+            return
+        exchanged = []
+        with self.conn.cursor() as cur:
+            # Blocks other writers (a leaf can't fill between its emptiness check and its exchange), not readers
+            cur.execute("LOCK TABLE ghcn_daily_test IN EXCLUSIVE MODE")
+            for leaf in self.leaves:
+                stage = self.stages.get(leaf['name'])
+                if not stage:
+                    continue
+                cur.execute(f"SELECT EXISTS (SELECT 1 FROM {leaf['name']})")
+                if leaf['start'] and not cur.fetchone()[0]:
+                    exchanged.append((leaf, stage))
+                    continue
+                cur.execute(f"INSERT INTO {leaf['name']} SELECT * FROM {stage}")
+                cur.execute(f"DROP TABLE {stage}")
+            # Last: EXCHANGE takes ACCESS EXCLUSIVE, which blocks readers until the commit
+            for leaf, stage in exchanged:
+                cur.execute(f"ALTER TABLE ghcn_daily_test EXCHANGE PARTITION FOR (%s) WITH TABLE {stage}", (leaf['start'],))
+                # After the exchange the stage table holds the old, empty leaf
+                cur.execute(f"DROP TABLE {stage}")
+        counts = [count for _, batch_counts, _ in self.pending for count in batch_counts]
+        errors = [error for batch_files, _, error in self.pending for _ in batch_files]
+        # Commits the loads and the statuses together
+        update_file_statuses(self.conn, files, 'COMPLETED', csv_record_counts=counts, error_conditions=errors)
+        print(f"Loaded {len(self.stages)} staged partitions ({len(exchanged)} exchanged into empty leaves, "
+              f"{len(self.stages) - len(exchanged)} inserted) for {len(files)} files in {time.time() - started:.1f}s")
+        self.stages = {}
+        self.pending = []
+
+def stage_batches(instances, limit, controller, lease_seconds, order, weighted, free_slots, ready, debug):
+    """
+    Stager thread for pipelined batch mode: claim the next batch on its own
+    session and symlink it into a free slot while the previous batch loads.
+    Puts (slot, files, loaded instances, controller settings used) on ready,
+    then None when done (or the exception that stopped it).
+    """
+    conn = psycopg2.connect(DSN)
+    try:
+        claimed = 0
+        while claimed < limit:
+            slot = free_slots.get()
+            settings = dict(controller.settings)
+            files = get_next_files(conn, min(settings['batch_size'], limit - claimed), lease_seconds, order)
+            if not files:
+                break
+            claimed += len(files)
+            assignment, weights, unservable = assign_files(files, controller.active_instances(instances, settings['streams']), weighted)
+            fail_unservable(conn, unservable)
+            files = [file_path for file_path in files if file_path not in set(unservable)]
+            if not files:
+                free_slots.put(slot)
+                continue
+            print(f"Slot {slot} balance: {balance_summary(assignment, weights)}")
+            loaded = distribute_files(assignment, f"slot{slot}")
+            if debug:
+                print(f"Staged {len(files)} files into slot {slot} on {len(loaded)} gpfdist instances")
+            ready.put((slot, files, loaded, settings))
+        ready.put(None)
+    except Exception as e:
+        ready.put(e)
+    finally:
+        conn.close()
+
+def run_pipelined_batches(conn, instances, controller, args, pbar):
+    """
+    Double-buffered batch mode: while batch N loads from one set of slot
+    directories, batch N+1 is claimed and staged into the other, so gpfdist
+    and the segments always have the next batch queued.
+    """
+    num_slots = 2
+    create_gpfdist_directories(instances, [f"slot{slot}" for slot in range(num_slots)])
+
+    free_slots = queue.Queue()
+    for slot in range(num_slots):
+        free_slots.put(slot)
+    ready = queue.Queue()
+    stager = threading.Thread(target=stage_batches, args=(instances, args.n, controller, args.lease_seconds, args.order, args.weighted, free_slots, ready, args.debug), daemon=True)
+    stager.start()
+
+    files_processed = 0
+    while True:
+        item = ready.get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+        slot, files, loaded, settings = item
+        print(f"Processing batch of {len(files)} files from slot {slot}...")
+        try:
+            check_gpfdist(instances, args.verbose)
+            started = time.time()
+            inserted, rejected = batch_process(conn, loaded, args.batch_size, args.verbose, args.display_definition, args.debug, slot=slot)
+            # Staging overlaps the previous load here, so only the load is timed
+            controller.observe(len(files), inserted, time.time() - started, settings)
+            counts = batch_record_counts(files)
+            # Commits the rows with the statuses, and only if every lease is still held
+            assert_leases_held(conn, files)
+            update_file_statuses(conn, files, 'COMPLETED', csv_record_counts=counts,
+                                 error_conditions=[batch_error(counts, inserted, rejected)] * len(files))
+        except LeaseLostError as e:
+            print(f"Rolled back batch from slot {slot}: {str(e)}")
+            conn.rollback()
+            requeue_files(conn, files)
+        except Exception as e:
+            print(f"Error loading batch from slot {slot}: {str(e)}")
+            conn.rollback()
+            update_file_statuses(conn, files, 'FAILED', error_conditions=[str(e)] * len(files))
+
+        clear_directories(loaded, f"slot{slot}")
+        free_slots.put(slot)
+        files_processed += len(files)
+        pbar.update(len(files))
+        if args.verbose:
+            print(f"Processed {files_processed} files so far.")
+
+    stager.join()
+    print("No more files to process.")
+    return files_processed
+
 def format_time(seconds):
     return str(timedelta(seconds=int(seconds)))
 
 def main():
     parser = argparse.ArgumentParser(description='Process GHCN data files.')
     parser.add_argument('-n', type=int, default=1, help='Number of files to process')
-    parser.add_argument('-g', type=int, default=1, help='Number of gpfdist processes to start')
+    parser.add_argument('-g', type=int, default=1, help='Number of gpfdist processes to start on each host')
+    parser.add_argument('--gpfdist-hosts', default='mdw', help='Comma-separated ETL hosts to run gpfdist on, as host[:data_root] where data_root is the processed CSV directory stored on that host (default: mdw)')
+    parser.add_argument('--gpfdist-port', type=int, default=8081, help='First gpfdist port on each host (default: 8081)')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
     parser.add_argument('-d', '--debug', action='store_true', help='Enable debug output')
     parser.add_argument('--display-definition', action='store_true', help='Display external table definition')
     parser.add_argument('-p', '--progress', action='store_true', help='Display progress bar')
     parser.add_argument('-b', '--batch', action='store_true', help='Enable batch processing')
     parser.add_argument('--batch-size', type=int, default=1000, help='Batch size for processing when using batch mode')
+    parser.add_argument('--verify-sample', type=float, default=0.0, help='Fraction of files (non-batch mode) that also get a full per-station COUNT(*) check (default: 0)')
+    parser.add_argument('--lease-seconds', type=int, default=DEFAULT_LEASE_SECONDS, help=f'Lease on claimed files, renewed by a heartbeat; files whose lease expires are reclaimed by other loaders (default: {DEFAULT_LEASE_SECONDS})')
+    parser.add_argument('--adaptive', action='store_true', help='In batch mode, tune the batch size and number of active gpfdist streams from measured rows/s')
+    parser.add_argument('--min-batch-size', type=int, default=100, help='Smallest batch size --adaptive may choose (default: 100)')
+    parser.add_argument('--max-batch-size', type=int, default=10000, help='Largest batch size --adaptive may choose (default: 10000)')
+    parser.add_argument('--max-batch-seconds', type=float, default=300, help='With --adaptive, halve the batch size after a batch slower than this (default: 300)')
+    parser.add_argument('--exchange', action='store_true', help='In batch mode, load through per-partition stage tables: empty partitions are swapped in with EXCHANGE PARTITION, the others get a plain INSERT')
+    parser.add_argument('--exchange-every', type=int, default=0, help='With --exchange, exchange staged partitions every N batches (default: 0, once at the end)')
+    parser.add_argument('--weighted', action='store_true', help='In per-file mode, weight file assignment by each gpfdist instance\'s observed throughput (batch loads can\'t be attributed to one instance)')
+    parser.add_argument('--order', choices=['name', 'size'], default='name', help='Claim files by name (default) or largest first by registered size')
+    parser.add_argument('--pipeline', action='store_true', help='In batch mode, claim and stage the next batch while the current one loads')
     args = parser.parse_args()
+    if args.pipeline and not args.batch:
+        parser.error('--pipeline requires -b/--batch')
+    if args.adaptive and not args.batch:
+        parser.error('--adaptive requires -b/--batch')
+    if args.weighted and args.batch:
+        parser.error('--weighted measures per-file loads and does not support -b/--batch')
+    if args.exchange and (not args.batch or args.pipeline):
+        parser.error('--exchange requires -b/--batch and does not support --pipeline')
+    if not 0 < args.min_batch_size <= args.max_batch_size:
+        parser.error('--min-batch-size must be positive and not above --max-batch-size')
+    if not 0.0 <= args.verify_sample <= 1.0:
+        parser.error('--verify-sample must be between 0 and 1')
+    if args.lease_seconds < 3:
+        parser.error('--lease-seconds must be at least 3')
 
-    conn = psycopg2.connect("dbname=climate_analysis user=gpadmin host=mdw")
+    conn = psycopg2.connect(DSN)
+    ensure_control_columns(conn)
+    heartbeat_stop = threading.Event()
+    heartbeat = threading.Thread(target=lease_heartbeat, args=(args.lease_seconds, heartbeat_stop, args.debug), daemon=True)
+    heartbeat.start()
+    print(f"Loader {LOADER_ID} leasing files for {args.lease_seconds}s at a time.")
     base_data_dir = '/home/gpadmin/data/ghcnd_all/processed_ghcn'
     work_dir = '/home/gpadmin/data/ghcnd_all/work_dir'
 
-    gpfdist_processes = []
-    gpfdist_ports = []
-    gpfdist_dirs = []
+    fleet = plan_gpfdist_fleet(parse_gpfdist_hosts(args.gpfdist_hosts, base_data_dir), args.g, args.gpfdist_port, work_dir, args.batch)
+    pool = None
+    conn_stats = {}
+    supervisor = None
+    supervisor_stop = threading.Event()
+    exit_code = 0
 
     try:
         # Progress: Starting gpfdist processes
         print("Starting gpfdist processes...")
         if args.batch:
-            gpfdist_dirs = create_gpfdist_directories(work_dir, args.g)
-
-        for i in range(args.g):
-            port = 8081 + i
-            dir_path = gpfdist_dirs[i] if args.batch else base_data_dir
-            process = start_gpfdist(dir_path, port, args.verbose)
-            if process:
-                gpfdist_processes.append(process)
-                gpfdist_ports.append(port)
-                print(f"Started gpfdist on port {port}")
-            else:
-                print(f"Failed to start gpfdist on port {port}")
-
-        if not gpfdist_ports:
+            create_gpfdist_directories(fleet)
+
+        started = time.time()
+        instances = start_gpfdist_fleet(fleet, args.verbose)
+        if not instances:
             print("No gpfdist processes started successfully. Exiting.")
-            return
+            return 1
+        print(f"Serving from {len(instances)} gpfdist instances on {len({instance['host'] for instance in instances})} hosts "
+              f"(ready in {time.time() - started:.1f}s)")
+        supervisor = threading.Thread(target=supervise_gpfdist, args=(instances, args.verbose, supervisor_stop), daemon=True)
+        supervisor.start()
+
+        # Active streams are a prefix of this order, so every host stays in use
+        instances = interleave_by_host(instances)
+        num_hosts = len({instance['host'] for instance in instances})
+        controller = BatchController(args.batch_size, len(instances),
+                                     min(args.min_batch_size, args.batch_size), max(args.max_batch_size, args.batch_size),
+                                     num_hosts, len(instances), args.max_batch_seconds, adaptive=args.adaptive)
 
         start_time = time.time()
         files_processed = 0
@@ -247,45 +1216,97 @@ def main():
 
         # Progress: Main processing loop
         print(f"Beginning to process {args.n} files...")
-        if args.batch:
+        if args.pipeline:
+            with tqdm(total=args.n, disable=not args.progress, desc="Batch Progress") as pbar:
+                files_processed = run_pipelined_batches(conn, instances, controller, args, pbar)
+        elif args.batch:
+            exchanger = PartitionExchanger(conn, args.debug) if args.exchange else None
+            batches_staged = 0
             with tqdm(total=args.n, disable=not args.progress, desc="Batch Progress") as pbar:
                 while files_processed < args.n:
-                    files = get_next_files(conn, min(args.batch_size, args.n - files_processed))
+                    files = get_next_files(conn, min(controller.batch_size, args.n - files_processed), args.lease_seconds, args.order)
                     if not files:
                         print("No more files to process.")
                         break
 
-                    print(f"Processing batch of {len(files)} files...")
-                    distribute_files(files, gpfdist_dirs)
-                    batch_process(conn, gpfdist_dirs, gpfdist_ports, args.batch_size, args.verbose, args.display_definition, args.debug)
+                    assignment, weights, unservable = assign_files(files, controller.active_instances(instances), args.weighted)
+                    fail_unservable(conn, unservable)
+                    files_processed += len(unservable)
+                    pbar.update(len(unservable))
+                    files = [file_path for file_path in files if file_path not in set(unservable)]
+                    if not files:
+                        continue
+
+                    print(f"Processing batch of {len(files)} files ({balance_summary(assignment, weights)})...")
+                    try:
+                        check_gpfdist(instances, args.verbose)
+                        started = time.time()
+                        loaded = distribute_files(assignment)
+                        inserted, rejected = batch_process(conn, loaded, args.batch_size, args.verbose, args.display_definition, args.debug,
+                                                           target_table=exchanger.landing if exchanger else 'ghcn_daily_test')
+                        counts = batch_record_counts(files)
+                        if exchanger:
+                            exchanger.stage_batch(files, counts, batch_error(counts, inserted, rejected))
+                        else:
+                            # Commits the rows with the statuses, and only if every lease is still held
+                            assert_leases_held(conn, files)
+                            update_file_statuses(conn, files, 'COMPLETED', csv_record_counts=counts,
+                                                 error_conditions=[batch_error(counts, inserted, rejected)] * len(files))
+                        controller.observe(len(files), inserted, time.time() - started)
+                    except LeaseLostError as e:
+                        print(f"Rolled back batch: {str(e)}")
+                        conn.rollback()
+                        requeue_files(conn, files)
+                        clear_directories(loaded)
+                        continue
+                    except Exception as e:
+                        # Claimed files are IN_PROGRESS; don't leave them stranded
+                        conn.rollback()
+                        update_file_statuses(conn, files, 'FAILED', error_conditions=[str(e)] * len(files))
+                        if exchanger:
+                            exchanger.exchange()  # keep the batches already staged
+                        raise
 
-                    for file_name in files:
-                        update_file_status(conn, file_name, 'COMPLETED')
+                    if exchanger:
+                        batches_staged += 1
+                        if args.exchange_every and batches_staged % args.exchange_every == 0:
+                            exchanger.exchange()
 
                     files_processed += len(files)
                     pbar.update(len(files))
 
-                    for dir_path in gpfdist_dirs:
-                        for file_name in os.listdir(dir_path):
-                            os.unlink(os.path.join(dir_path, file_name))
+                    clear_directories(loaded)
 
                     if args.verbose:
                         print(f"Processed {files_processed} files so far.")
+            if exchanger:
+                exchanger.exchange()
         else:
-            with ThreadPoolExecutor(max_workers=args.g) as executor:
-                futures = []
+            # One session per worker thread, so per-file loads (and any
+            # rollback) are independent of each other. One file per gpfdist
+            # instance per round, so every host's instances serve at once
+            streams = len(instances)
+            pool = ThreadedConnectionPool(streams, streams, DSN)
+            stats_lock = threading.Lock()
+            with ThreadPoolExecutor(max_workers=streams) as executor:
                 with tqdm(total=args.n, disable=not args.progress, desc="File Progress") as pbar:
                     while files_processed < args.n:
-                        files = get_next_files(conn, min(args.g, args.n - files_processed))
+                        files = get_next_files(conn, min(streams, args.n - files_processed), args.lease_seconds, args.order)
                         if not files:
                             print("No more files to process.")
                             break
 
-                        for file_name in files:
-                            if files_processed >= args.n:
-                                break
-                            futures.append(executor.submit(process_file, file_name, conn, gpfdist_ports, args.verbose, args.display_definition, args.debug))
-                            files_processed += 1
+                        check_gpfdist(instances, args.verbose)
+                        files_processed += len(files)
+                        assignment, weights, unservable = assign_files(files, instances, args.weighted)
+                        fail_unservable(conn, unservable)
+                        pbar.update(len(unservable))
+                        if args.verbose:
+                            print(f"Round balance: {balance_summary(assignment, weights)}")
+                        futures = []
+                        for instance, instance_files, _ in assignment:
+                            for file_name in instance_files:
+                                futures.append(executor.submit(process_file_pooled, file_name, pool, conn_stats, stats_lock, instance, args.verbose, args.display_definition, args.debug, args.verify_sample))
 
                         for future in as_completed(futures):
                             future.result()
@@ -309,20 +1330,31 @@ def main():
             print(f"Average time per file: {format_time(avg_time_per_file)}")
         else:
             print("Average time per file: N/A (no files processed)")
+        if conn_stats:
+            print_connection_stats(conn_stats)
+        print_gpfdist_stats(instances, elapsed_time)
 
     except Exception as e:
         print(f"An error occurred: {str(e)}")
+        exit_code = 1
     finally:
         # Progress: Cleanup
         print("\nCleaning up...")
-        stop_gpfdist(gpfdist_processes)
+        supervisor_stop.set()
+        if supervisor:
+            supervisor.join()
+        stop_gpfdist(fleet)
 
         if args.batch:
-            for dir_path in gpfdist_dirs:
-                shutil.rmtree(dir_path, ignore_errors=True)
+            remove_gpfdist_directories(fleet)
 
+        heartbeat_stop.set()
+        heartbeat.join()
+        if pool:
+            pool.closeall()
         conn.close()
         print("Cleanup complete.")
+    return exit_code
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())